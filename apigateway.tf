@@ -201,6 +201,9 @@ resource "aws_api_gateway_rest_api" "user_service_endpoint" {
   description = "User Service Endpoint"
 
   disable_execute_api_endpoint = true
+
+  # let the proxy return base64 bodies (images, fonts, compressed assets) as binary
+  binary_media_types = ["*/*"]
 }
 
 resource "aws_api_gateway_method" "user_service_method" {
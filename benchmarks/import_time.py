@@ -0,0 +1,107 @@
+"""Measure module init (import) time of each sandbox Lambda handler against a per-handler budget.
+
+Every sample imports ``lambda_function`` in a fresh interpreter, the same work Lambda does in the init
+phase of a cold start. The shared layer is put on ``sys.path`` the way ``/opt/python`` is in Lambda, so
+the handler dependencies (boto3) must be installed locally.
+
+    python benchmarks/import_time.py --runs 10 --output import_time.json
+
+Exits non-zero when a handler's median init time is over its budget.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDAS_DIR = os.path.join(REPO_ROOT, "lambdas")
+SHARED_LAYER_DIR = os.path.join(LAMBDAS_DIR, "shared", "python")
+
+# Median module init budget in milliseconds. Handlers build their AWS clients lazily, so none of them
+# should need more than the standard library and a few small modules at import.
+IMPORT_BUDGETS_MS = {
+    "provision-sandbox": 50,
+    "shutdown-sandbox": 50,
+    "monitor-sandbox": 50,
+    "restart-sandbox": 50,
+    "prewarm-sandbox": 50,
+    "deprovision-sandbox": 50,
+    "proxy-request": 150,  # imports urllib3 for the upstream pools
+}
+
+MEASURE_SNIPPET = """
+import sys, time
+start = time.perf_counter()
+import lambda_function
+elapsed = time.perf_counter() - start
+print(round(elapsed * 1000, 3))
+print(",".join(sorted(m for m in ("boto3", "botocore", "requests", "urllib3") if m in sys.modules)))
+"""
+
+
+def measure_once(handler):
+    env = dict(os.environ)
+    env.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [SHARED_LAYER_DIR, env.get("PYTHONPATH")]))
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE_SNIPPET],
+        cwd=os.path.join(LAMBDAS_DIR, handler),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    ).stdout.splitlines()
+
+    return float(output[0]), output[1].split(",") if output[1] else []
+
+
+def measure(handler, runs):
+    samples = []
+    loaded_modules = []
+    for _ in range(runs):
+        elapsed_ms, loaded_modules = measure_once(handler)
+        samples.append(elapsed_ms)
+
+    median_ms = statistics.median(samples)
+    budget_ms = IMPORT_BUDGETS_MS[handler]
+    return {
+        "handler": handler,
+        "runs": runs,
+        "median_ms": round(median_ms, 3),
+        "min_ms": round(min(samples), 3),
+        "max_ms": round(max(samples), 3),
+        "budget_ms": budget_ms,
+        "within_budget": median_ms <= budget_ms,
+        "heavy_modules_loaded": loaded_modules,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per handler")
+    parser.add_argument("--handler", action="append", choices=sorted(IMPORT_BUDGETS_MS), help="limit to a handler")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = [measure(handler, args.runs) for handler in (args.handler or IMPORT_BUDGETS_MS)]
+
+    for result in results:
+        status = "ok" if result["within_budget"] else "OVER BUDGET"
+        print(
+            f"{result['handler']:<18} median {result['median_ms']:>8.1f}ms "
+            f"(budget {result['budget_ms']}ms) {status} loaded: {', '.join(result['heavy_modules_loaded']) or '-'}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+
+    return 0 if all(r["within_budget"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,275 @@
+"""Offline benchmark of the proxy-request hot path with a per-stage latency breakdown.
+
+Drives ``lambda_handler`` from ``lambdas/proxy-request`` with synthetic API Gateway events. CloudMap,
+DynamoDB, CloudWatch Logs and Lambda are replaced by local stand-ins with injected latency, and the
+sandbox is a local HTTP server, so no AWS account is needed (boto3 is never imported). Only urllib3
+has to be installed.
+
+Cold runs load a fresh copy of the handler module for every request (empty warm-container caches),
+warm runs reuse one module for all requests.
+
+    python benchmarks/proxy_hot_path.py --warm-requests 500 --cold-requests 20 --output proxy.json
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROXY_HANDLER_PATH = os.path.join(REPO_ROOT, "lambdas", "proxy-request", "lambda_function.py")
+SHARED_LAYER_DIR = os.path.join(REPO_ROOT, "lambdas", "shared", "python")
+
+FULL_DOMAIN = "example.com"
+HOST = f"1-sandbox-user.gh.{FULL_DOMAIN}"
+SERVICE_UUID = "00000000-0000-0000-0000-000000000001"
+
+# stage name -> handler module function that is timed for it
+STAGES = {
+    "discovery": "discover_service_instances",
+    "uuid_lookup": "get_sandbox_from_domain",
+    "logging": "record_request_activity",
+    "forward": "forward_request",
+}
+
+PROXY_ENVIRONMENT = {
+    "full_domain": FULL_DOMAIN,
+    "cloudmap_namespace": "benchmark-namespace",
+    "metadata_ddb_table_name": "benchmark-metadata",
+    "ecs_access_log_group_name": "benchmark-access-logs",
+    "startup_task_lambda_arn": "arn:aws:lambda:eu-west-2:000000000000:function:benchmark-restart",
+}
+
+
+class StandIn:
+    """Local replacement for a boto3 client, every call sleeps for the injected latency first."""
+
+    class exceptions:
+        class ConditionalCheckFailedException(Exception):
+            pass
+
+    def __init__(self, latency_ms, responses):
+        self.latency_seconds = latency_ms / 1000
+        self.responses = responses
+        self.calls = 0
+
+    def __getattr__(self, operation):
+        if operation not in self.responses:
+            raise AttributeError(operation)
+
+        def call(**kwargs):
+            self.calls += 1
+            time.sleep(self.latency_seconds)
+            response = self.responses[operation]
+            return response(kwargs) if callable(response) else response
+
+        return call
+
+
+def build_stand_ins(args, upstream_endpoint):
+    return {
+        "cloudmap_client": StandIn(args.cloudmap_latency_ms, {
+            "discover_instances": {"Instances": [{"Attributes": {"AWS_INSTANCE_IPV4": upstream_endpoint}}]},
+        }),
+        "dynamodb_client": StandIn(args.dynamodb_latency_ms, {
+            "query": {"Items": [{"uuid": {"S": SERVICE_UUID}}]},
+            "get_item": {"Item": {"uuid": {"S": SERVICE_UUID}, "desired_tasks": {"N": "1"}}},
+            "update_item": {},
+        }),
+        "cloudwatch_client": StandIn(args.logs_latency_ms, {"put_log_events": {}}),
+        "lambda_client": StandIn(args.lambda_latency_ms, {"invoke": {"StatusCode": 202}}),
+    }
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out as separate writes, without this delayed ACKs add ~40ms per kept-alive request
+    disable_nagle_algorithm = True
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        time.sleep(self.server.latency_seconds)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(self.server.body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = do_HEAD = do_OPTIONS = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_upstream(latency_ms, body_bytes):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), UpstreamHandler)
+    server.daemon_threads = True
+    server.latency_seconds = latency_ms / 1000
+    server.body = (b"<p>sandbox</p>" * (body_bytes // 14 + 1))[:body_bytes]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"127.0.0.1:{server.server_address[1]}"
+
+
+class StageRecorder:
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+        self.samples["total"] = []
+        self._lock = threading.Lock()
+
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, (time.perf_counter() - start) * 1000)
+
+        return timed
+
+    def add(self, stage, elapsed_ms):
+        with self._lock:
+            self.samples[stage].append(elapsed_ms)
+
+
+def load_handler(module_name, stand_ins, recorder):
+    spec = importlib.util.spec_from_file_location(module_name, PROXY_HANDLER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    for name, client in stand_ins.items():
+        setattr(module, name, client)
+    # the metadata store captured the real client at import
+    module.metadata_store.client = stand_ins["dynamodb_client"]
+    for stage, function_name in STAGES.items():
+        setattr(module, function_name, recorder.wrap(stage, getattr(module, function_name)))
+    return module
+
+
+def make_event(method):
+    return {
+        "httpMethod": method,
+        "path": "/index.html",
+        "headers": {"Host": HOST, "Accept": "text/html", "Accept-Encoding": "gzip"},
+        "queryStringParameters": None,
+        "body": None,
+        "isBase64Encoded": False,
+        "requestContext": {"domainName": HOST},
+    }
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarise(recorder, requests, elapsed_seconds):
+    stages = {}
+    for stage, samples in recorder.samples.items():
+        if not samples:
+            stages[stage] = {"calls": 0}
+            continue
+        stages[stage] = {
+            "calls": len(samples),
+            "p50_ms": round(percentile(samples, 50), 3),
+            "p95_ms": round(percentile(samples, 95), 3),
+            "p99_ms": round(percentile(samples, 99), 3),
+            "max_ms": round(max(samples), 3),
+        }
+    return {
+        "requests": requests,
+        "elapsed_seconds": round(elapsed_seconds, 3),
+        "throughput_rps": round(requests / elapsed_seconds, 2) if elapsed_seconds else None,
+        "stages": stages,
+    }
+
+
+def run(label, requests, args, upstream_endpoint, cold):
+    recorder = StageRecorder()
+    stand_ins = build_stand_ins(args, upstream_endpoint)
+    module = None if cold else load_handler("proxy_benchmark_warm", stand_ins, recorder)
+    status_codes = {}
+
+    started = time.perf_counter()
+    for i in range(requests):
+        if cold:
+            if module is not None:
+                module.background_executor.shutdown(wait=True)
+            # a cold container has nothing cached, but the AWS clients would be reused across calls
+            module = load_handler(f"proxy_benchmark_cold_{i}", stand_ins, recorder)
+
+        request_start = time.perf_counter()
+        response = module.lambda_handler(make_event(args.method), None)
+        recorder.add("total", (time.perf_counter() - request_start) * 1000)
+        status_codes[response["statusCode"]] = status_codes.get(response["statusCode"], 0) + 1
+    elapsed = time.perf_counter() - started
+
+    module.background_executor.shutdown(wait=True)
+
+    summary = summarise(recorder, requests, elapsed)
+    summary["status_codes"] = {str(k): v for k, v in sorted(status_codes.items())}
+    summary["aws_calls"] = {name.replace("_client", ""): client.calls for name, client in stand_ins.items()}
+    return label, summary
+
+
+def print_summary(label, summary):
+    print(f"\n{label}: {summary['requests']} requests, {summary['throughput_rps']} req/s, "
+          f"status codes {summary['status_codes']}, AWS calls {summary['aws_calls']}")
+    print(f"  {'stage':<12} {'calls':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for stage, stats in summary["stages"].items():
+        if not stats["calls"]:
+            print(f"  {stage:<12} {0:>6}")
+            continue
+        print(f"  {stage:<12} {stats['calls']:>6} {stats['p50_ms']:>7.2f}ms {stats['p95_ms']:>7.2f}ms "
+              f"{stats['p99_ms']:>7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--warm-requests", type=int, default=200)
+    parser.add_argument("--cold-requests", type=int, default=20)
+    parser.add_argument("--method", default="GET")
+    parser.add_argument("--cloudmap-latency-ms", type=float, default=15)
+    parser.add_argument("--dynamodb-latency-ms", type=float, default=8)
+    parser.add_argument("--logs-latency-ms", type=float, default=20)
+    parser.add_argument("--lambda-latency-ms", type=float, default=20)
+    parser.add_argument("--upstream-latency-ms", type=float, default=5)
+    parser.add_argument("--upstream-body-bytes", type=int, default=16 * 1024)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the handler's own log output")
+    args = parser.parse_args()
+
+    os.environ.update(PROXY_ENVIRONMENT)
+    sys.path.insert(0, SHARED_LAYER_DIR)
+
+    server, upstream_endpoint = start_upstream(args.upstream_latency_ms, args.upstream_body_bytes)
+    # the handler prints log and EMF metric lines, keep them out of the report unless asked for
+    handler_output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with handler_output:
+            results = dict([
+                run("cold", args.cold_requests, args, upstream_endpoint, cold=True),
+                run("warm", args.warm_requests, args, upstream_endpoint, cold=False),
+            ])
+    finally:
+        server.shutdown()
+
+    for label, summary in results.items():
+        print_summary(label, summary)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,14 @@ resource "aws_cloudwatch_log_group" "monitor_sandbox_lambda" {
   name = "/${var.company_prefix}-sandbox/lambda/monitor-sandbox/"
 }
 
+resource "aws_cloudwatch_log_group" "prewarm_sandbox_lambda" {
+  name = "/${var.company_prefix}-sandbox/lambda/prewarm-sandbox/"
+}
+
+resource "aws_cloudwatch_log_group" "deprovision_sandbox_lambda" {
+  name = "/${var.company_prefix}-sandbox/lambda/deprovision-sandbox/"
+}
+
 resource "aws_cloudwatch_log_group" "api_gateway" {
   name = "/${var.company_prefix}-sandbox/api_gateway/"
 }
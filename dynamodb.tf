@@ -18,13 +18,43 @@ resource "aws_dynamodb_table" "metadata_table" {
     type = "S"
   }
 
+  attribute {
+    name = "is_running"
+    type = "S"
+  }
+
+  attribute {
+    name = "next_shutdown_at"
+    type = "S"
+  }
+
+  attribute {
+    name = "pool_slot"
+    type = "S"
+  }
+
   hash_key = "uuid"
 
   global_secondary_index {
     name            = "DomainIndex"
     hash_key        = "domain"
     projection_type = "INCLUDE"
-    non_key_attributes = ["uuid"]
+    non_key_attributes = ["uuid", "cloudmap_service_name"]
+  }
+
+  # sparse, only running sandboxes carry "is_running", for the shutdown-sandbox reaper sweep
+  global_secondary_index {
+    name            = "RunningIndex"
+    hash_key        = "is_running"
+    range_key       = "next_shutdown_at"
+    projection_type = "KEYS_ONLY"
+  }
+
+  # sparse, only unclaimed warm pool slots carry "pool_slot", claimed by provision-sandbox
+  global_secondary_index {
+    name            = "PoolIndex"
+    hash_key        = "pool_slot"
+    projection_type = "KEYS_ONLY"
   }
 
   tags = {
@@ -45,12 +75,30 @@ output "my_dynamodb_output_arn" {
 # repository
 # user
 # registry
-# task_status = ["ACTIVE", "STOPPED", "STARTING"]
+# task_status = ["ACTIVE", "STOPPED", "STARTING", "STOPPING", "MISSING", "DELETING"]
 # desired_tasks
+# running_tasks (reconciled from ECS by monitor-sandbox)
+# reconciled_at
 # domain
 # created_at
 # updated_at
 # task_definition_arn
 # cloudmap_service_arn
+# cloudmap_service_name (name proxy-request discovers instances by, the domain unless the sandbox came from the warm pool)
 # shutdown_schedule_arn
-# next_shutdown_at
\ No newline at end of file
+# next_shutdown_at
+# is_running ("1" while the sandbox is up, removed on shutdown; hash key of RunningIndex)
+# last_activity_at (epoch seconds, written by proxy-request at most once per activity_write_interval_seconds)
+# wake_lease_until (epoch seconds, set by proxy-request so only one request wakes a stopped sandbox)
+# pool_slot ("available" on an unclaimed warm pool slot, removed when provision-sandbox claims it; hash key of PoolIndex)
+# deprovisioned_domain (domain of a DELETING sandbox, its claim is released once deprovision-sandbox deletes the row)
+#
+# -- DOMAIN CLAIMS --
+# uuid = "domain#<domain>", written by provision-sandbox before it creates anything so one PR gets one sandbox
+# owner_uuid (uuid of the sandbox owning the domain, kept by a DELETING sandbox until its CloudMap service is gone)
+# claim_expires_at (epoch seconds, a claim whose owner never wrote its row can be taken over after it)
+#
+# -- LEASES --
+# uuid = "lease#<name>", held by one run of a scheduled job at a time (e.g. "lease#warm-pool-refill")
+# owner_uuid (request id of the run holding the lease)
+# lease_until (epoch seconds, an expired lease can be taken over)
@@ -31,7 +31,15 @@ resource "aws_iam_policy" "scheduler_role_invoke_shutdown_lambda" {
         Effect   = "Allow"
         Resource = [
           module.shutdown_sandbox_lambda.lambda_arn,
-          "${module.shutdown_sandbox_lambda.lambda_arn}:*"
+          "${module.shutdown_sandbox_lambda.lambda_arn}:*",
+          module.monitor_sandbox_lambda.lambda_arn,
+          "${module.monitor_sandbox_lambda.lambda_arn}:*",
+          module.prewarm_sandbox_lambda.lambda_arn,
+          "${module.prewarm_sandbox_lambda.lambda_arn}:*",
+          module.provision_sandbox_lambda.lambda_arn,
+          "${module.provision_sandbox_lambda.lambda_arn}:*",
+          module.deprovision_sandbox_lambda.lambda_arn,
+          "${module.deprovision_sandbox_lambda.lambda_arn}:*"
         ]
       }
     ]
@@ -41,4 +49,98 @@ resource "aws_iam_policy" "scheduler_role_invoke_shutdown_lambda" {
 resource "aws_iam_role_policy_attachment" "scheduler_role_invoke_shutdown_lambda" {
   role       = aws_iam_role.scheduler_role_invoke_shutdown_lambda.name
   policy_arn = aws_iam_policy.scheduler_role_invoke_shutdown_lambda.arn
-}
\ No newline at end of file
+}
+
+# One sweep every minute shuts down every sandbox past its next_shutdown_at (see shutdown-sandbox reap mode)
+resource "aws_scheduler_schedule" "idle_reaper" {
+  name       = "${var.company_prefix}-idle-reaper"
+  group_name = aws_scheduler_schedule_group.default.name
+  state      = var.idle_reaper_enabled ? "ENABLED" : "DISABLED"
+
+  flexible_time_window {
+    mode = "OFF"
+  }
+
+  schedule_expression = "rate(1 minute)"
+
+  target {
+    arn      = module.shutdown_sandbox_lambda.lambda_arn
+    role_arn = aws_iam_role.scheduler_role_invoke_shutdown_lambda.arn
+    input    = jsonencode({ "reap" : true })
+  }
+}
+
+# Reconcile task status and task counts in the metadata table with ECS for the whole fleet
+resource "aws_scheduler_schedule" "fleet_reconciler" {
+  name       = "${var.company_prefix}-fleet-reconciler"
+  group_name = aws_scheduler_schedule_group.default.name
+
+  flexible_time_window {
+    mode = "OFF"
+  }
+
+  schedule_expression = "rate(5 minutes)"
+
+  target {
+    arn      = module.monitor_sandbox_lambda.lambda_arn
+    role_arn = aws_iam_role.scheduler_role_invoke_shutdown_lambda.arn
+    input    = jsonencode({})
+  }
+}
+
+# Five minutes before every full hour, start the stopped sandboxes that are usually used in that hour (UTC)
+resource "aws_scheduler_schedule" "prewarm_planner" {
+  name       = "${var.company_prefix}-prewarm-planner"
+  group_name = aws_scheduler_schedule_group.default.name
+  state      = var.prewarm_enabled ? "ENABLED" : "DISABLED"
+
+  flexible_time_window {
+    mode = "OFF"
+  }
+
+  schedule_expression = "cron(55 * * * ? *)"
+
+  target {
+    arn      = module.prewarm_sandbox_lambda.lambda_arn
+    role_arn = aws_iam_role.scheduler_role_invoke_shutdown_lambda.arn
+    input    = jsonencode({})
+  }
+}
+
+# Top the warm pool back up to var.warm_pool_size unclaimed slots after provisions have claimed some
+resource "aws_scheduler_schedule" "warm_pool_refill" {
+  name       = "${var.company_prefix}-warm-pool-refill"
+  group_name = aws_scheduler_schedule_group.default.name
+  state      = var.warm_pool_size > 0 ? "ENABLED" : "DISABLED"
+
+  flexible_time_window {
+    mode = "OFF"
+  }
+
+  schedule_expression = "rate(1 minute)"
+
+  target {
+    arn      = module.provision_sandbox_lambda.lambda_arn
+    role_arn = aws_iam_role.scheduler_role_invoke_shutdown_lambda.arn
+    input    = jsonencode({ "refill_pool" : true })
+  }
+}
+
+# Once a day, delete the sandboxes nobody has used for var.gc_retention_days (see deprovision-sandbox gc mode)
+resource "aws_scheduler_schedule" "sandbox_gc" {
+  name       = "${var.company_prefix}-sandbox-gc"
+  group_name = aws_scheduler_schedule_group.default.name
+  state      = var.gc_enabled ? "ENABLED" : "DISABLED"
+
+  flexible_time_window {
+    mode = "OFF"
+  }
+
+  schedule_expression = "cron(0 3 * * ? *)"
+
+  target {
+    arn      = module.deprovision_sandbox_lambda.lambda_arn
+    role_arn = aws_iam_role.scheduler_role_invoke_shutdown_lambda.arn
+    input    = jsonencode({ "gc" : true })
+  }
+}
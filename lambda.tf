@@ -1,3 +1,20 @@
+# Shared python code for the sandbox lambdas (lambdas/shared/python/sandbox_shared), mounted at /opt/python
+
+data "archive_file" "shared_layer" {
+  type        = "zip"
+  source_dir  = "lambdas/shared"
+  output_path = "lambdas/shared_layer.zip"
+  excludes    = ["python/sandbox_shared/__pycache__"]
+}
+
+resource "aws_lambda_layer_version" "shared" {
+  filename         = data.archive_file.shared_layer.output_path
+  source_code_hash = data.archive_file.shared_layer.output_base64sha256
+  layer_name       = "${var.company_prefix}-shared"
+
+  compatible_runtimes = ["python3.9", "python3.10"]
+}
+
 # Lambda for creating initial service e.g. from github
 
 module "provision_sandbox_lambda" {
@@ -8,9 +25,10 @@ module "provision_sandbox_lambda" {
   lambda_name             = "provision-sandbox"
   lambda_source_file_path = "lambdas/provision-sandbox/lambda_function.py"
   lambda_output_file_path = "lambdas/provision-sandbox/lambda_function.zip"
+  lambda_layer_arns       = [aws_lambda_layer_version.shared.arn]
 
   lambda_runtime = "python3.9"
-  lambda_timeout = 20
+  lambda_timeout = 120  # batches provision many sandboxes per invocation
 
   lambda_in_vpc = true
   vpc_subnet_ids = [
@@ -26,7 +44,9 @@ module "provision_sandbox_lambda" {
         "Sid" : "EventBridgeScheduler",
         "Effect" : "Allow",
         "Action" : [
-          "scheduler:CreateSchedule"
+          "scheduler:CreateSchedule",
+          "scheduler:UpdateSchedule",
+          "scheduler:DeleteSchedule"
         ],
         "Resource" : "arn:aws:scheduler:${var.region}:${local.account_id}:schedule/${aws_scheduler_schedule_group.default.name}/*"
       },
@@ -35,6 +55,8 @@ module "provision_sandbox_lambda" {
         "Effect" : "Allow",
         "Action" : [
           "ecs:CreateService",
+          "ecs:UpdateService",
+          "ecs:DeleteService",
           "ecs:RegisterTaskDefinition",
           "ecs:TagResource"
         ],
@@ -44,13 +66,28 @@ module "provision_sandbox_lambda" {
           "arn:aws:ecs:${var.region}:${local.account_id}:service/demo-sandbox-system-sandbox-cluster/demo-sandbox-system-*"
         ]
       },
+      {
+        "Sid" : "InvokeDeprovisionLambda",
+        "Effect" : "Allow",
+        "Action" : "lambda:InvokeFunction",
+        "Resource" : module.deprovision_sandbox_lambda.lambda_arn
+      },
+      {
+        "Sid" : "ECSTaskDefinitionLookup",
+        "Effect" : "Allow",
+        "Action" : [
+          "ecs:DescribeTaskDefinition"
+        ],
+        "Resource" : "*"
+      },
       {
         "Sid" : "CloudMap"
         "Effect" : "Allow",
         "Action" : [
           "servicediscovery:RegisterInstance",
           "servicediscovery:CreateService",
-          "servicediscovery:GetService"
+          "servicediscovery:GetService",
+          "servicediscovery:DeleteService"
         ],
         "Resource" : [
           "arn:aws:servicediscovery:${var.region}:${local.account_id}:service/*",
@@ -71,6 +108,14 @@ module "provision_sandbox_lambda" {
           "arn:aws:events:${var.region}:${local.account_id}:rule/${var.company_prefix}-*"
         ]
       },
+      {
+        "Sid" : "AccessLogStreamRollback",
+        "Effect" : "Allow",
+        "Action" : [
+          "logs:DeleteLogStream"
+        ],
+        "Resource" : "arn:aws:logs:${var.region}:${local.account_id}:log-group:${aws_cloudwatch_log_group.ecs_access_logs.name}:log-stream:*"
+      },
       {
         "Sid" : "DynamoDB",
         "Effect" : "Allow",
@@ -78,9 +123,15 @@ module "provision_sandbox_lambda" {
           "dynamodb:PutItem",
           "dynamodb:BatchWriteItem",
           "dynamodb:UpdateItem",
-          "dynamodb:GetItem"
+          "dynamodb:GetItem",
+          "dynamodb:DeleteItem",
+          "dynamodb:Query"
         ],
-        "Resource" : "arn:aws:dynamodb:${var.region}:${local.account_id}:table/${aws_dynamodb_table.metadata_table.name}"
+        "Resource" : [
+          "arn:aws:dynamodb:${var.region}:${local.account_id}:table/${aws_dynamodb_table.metadata_table.name}",
+          "arn:aws:dynamodb:${var.region}:${local.account_id}:table/${aws_dynamodb_table.metadata_table.name}/index/DomainIndex",
+          "arn:aws:dynamodb:${var.region}:${local.account_id}:table/${aws_dynamodb_table.metadata_table.name}/index/PoolIndex"
+        ]
       },
       {
         "Sid" : "AWSLambdaVPCAccessExecutionPermissions",
@@ -113,21 +164,25 @@ module "provision_sandbox_lambda" {
   })
 
   environment_variables = {
-    "company_prefix"            = var.company_prefix
-    "domain"                    = var.domain
-    "metadata_ddb_table"        = aws_dynamodb_table.metadata_table.name
-    "cloudmap_namespace_id"     = aws_service_discovery_http_namespace.main_api_namespace.id
-    "ecs_task_role_arn"         = aws_iam_role.ecs_task_role.arn
-    "ecs_execution_role_arn"    = aws_iam_role.ecs_execution_role.arn
-    "ecs_log_group_arn"         = aws_cloudwatch_log_group.ecs.name
-    "ecs_log_group_region"      = var.region,
-    "ecs_access_log_group_name" = aws_cloudwatch_log_group.ecs_access_logs.name
-    "ecs_cluster_arn"           = aws_ecs_cluster.main.arn
-    "ecs_subnets"               = "${aws_subnet.private_1a_with_nat.id},${aws_subnet.private_1b_with_nat.id},${aws_subnet.private_1c_with_nat.id}"
-    "ecs_security_groups"       = "${aws_security_group.ecs.id}"
-    "shutdown_lambda_arn"       = module.shutdown_sandbox_lambda.lambda_arn
-    "scheduler_role_arn"        = aws_iam_role.scheduler_role_invoke_shutdown_lambda.arn
-    "scheduler_group_name"      = aws_scheduler_schedule_group.default.name
+    "company_prefix"              = var.company_prefix
+    "domain"                      = var.domain
+    "metadata_ddb_table"          = aws_dynamodb_table.metadata_table.name
+    "cloudmap_namespace_id"       = aws_service_discovery_http_namespace.main_api_namespace.id
+    "ecs_task_role_arn"           = aws_iam_role.ecs_task_role.arn
+    "ecs_execution_role_arn"      = aws_iam_role.ecs_execution_role.arn
+    "ecs_log_group_arn"           = aws_cloudwatch_log_group.ecs.name
+    "ecs_log_group_region"        = var.region,
+    "ecs_access_log_group_name"   = aws_cloudwatch_log_group.ecs_access_logs.name
+    "ecs_cluster_arn"             = aws_ecs_cluster.main.arn
+    "ecs_subnets"                 = "${aws_subnet.private_1a_with_nat.id},${aws_subnet.private_1b_with_nat.id},${aws_subnet.private_1c_with_nat.id}"
+    "ecs_security_groups"         = "${aws_security_group.ecs.id}"
+    "shutdown_lambda_arn"         = module.shutdown_sandbox_lambda.lambda_arn
+    "scheduler_role_arn"          = aws_iam_role.scheduler_role_invoke_shutdown_lambda.arn
+    "scheduler_group_name"        = aws_scheduler_schedule_group.default.name
+    "idle_reaper_enabled"         = tostring(var.idle_reaper_enabled)
+    "warm_pool_size"              = tostring(var.warm_pool_size)
+    "provision_batch_concurrency" = tostring(var.provision_batch_concurrency)
+    "deprovision_lambda_arn"      = module.deprovision_sandbox_lambda.lambda_arn
   }
 
   log_group_name = aws_cloudwatch_log_group.provision_sandbox_lambda.name
@@ -158,10 +213,11 @@ module "shutdown_sandbox_lambda" {
   lambda_name             = "shutdown-sandbox"
   lambda_source_file_path = "lambdas/shutdown-sandbox/lambda_function.py"
   lambda_output_file_path = "lambdas/shutdown-sandbox/lambda_function.zip"
+  lambda_layer_arns       = [aws_lambda_layer_version.shared.arn]
   lambda_dependencies_zip_path = "lambdas/shutdown-sandbox/python.zip"
 
   lambda_runtime = "python3.9"
-  lambda_timeout = 20
+  lambda_timeout = 60  # reaper sweeps shut down many sandboxes per invocation
 
   lambda_in_vpc = false
 
@@ -198,9 +254,13 @@ module "shutdown_sandbox_lambda" {
         "Effect" : "Allow",
         "Action" : [
           "dynamodb:UpdateItem",
-          "dynamodb:GetItem"
+          "dynamodb:GetItem",
+          "dynamodb:Query"
         ],
-        "Resource" : "arn:aws:dynamodb:${var.region}:${local.account_id}:table/${aws_dynamodb_table.metadata_table.name}"
+        "Resource" : [
+          "arn:aws:dynamodb:${var.region}:${local.account_id}:table/${aws_dynamodb_table.metadata_table.name}",
+          "arn:aws:dynamodb:${var.region}:${local.account_id}:table/${aws_dynamodb_table.metadata_table.name}/index/RunningIndex"
+        ]
       },
       {
         "Sid" : "AWSLambdaVPCAccessExecutionPermissions",
@@ -232,7 +292,6 @@ module "shutdown_sandbox_lambda" {
         "Sid" : "EventBridgeGetSchedule",
         "Effect" : "Allow",
         "Action" : [
-          "scheduler:GetSchedule",
           "scheduler:UpdateSchedule"
         ],
         "Resource" : "arn:aws:scheduler:${var.region}:${local.account_id}:schedule/${aws_scheduler_schedule_group.default.name}/*"
@@ -248,6 +307,8 @@ module "shutdown_sandbox_lambda" {
       "ecs_cluster_arn"           = aws_ecs_cluster.main.arn,
       "ecs_access_log_group_name" = aws_cloudwatch_log_group.ecs_access_logs.name
       "scheduler_group_name"      = aws_scheduler_schedule_group.default.name
+      "idle_reaper_enabled"       = tostring(var.idle_reaper_enabled)
+      "scheduler_role_arn"        = aws_iam_role.scheduler_role_invoke_shutdown_lambda.arn
   }
 
   log_group_name = aws_cloudwatch_log_group.shutdown_sandbox_lambda.name
@@ -263,6 +324,7 @@ module "restart_sandbox_lambda" {
   lambda_name             = "restart-sandbox"
   lambda_source_file_path = "lambdas/restart-sandbox/lambda_function.py"
   lambda_output_file_path = "lambdas/restart-sandbox/lambda_function.zip"
+  lambda_layer_arns       = [aws_lambda_layer_version.shared.arn]
   lambda_dependencies_zip_path = "lambdas/restart-sandbox/python.zip"
 
   lambda_runtime = "python3.10"
@@ -320,7 +382,7 @@ module "restart_sandbox_lambda" {
         "Sid" : "EventBridgeGetSchedule",
         "Effect" : "Allow",
         "Action" : [
-          "scheduler:GetSchedule",
+          "scheduler:CreateSchedule",
           "scheduler:UpdateSchedule"
         ],
         "Resource" : "arn:aws:scheduler:${var.region}:${local.account_id}:schedule/${aws_scheduler_schedule_group.default.name}/*"
@@ -336,6 +398,9 @@ module "restart_sandbox_lambda" {
       "ecs_cluster_arn"           = aws_ecs_cluster.main.arn,
       "ecs_access_log_group_name" = aws_cloudwatch_log_group.ecs_access_logs.name
       "scheduler_group_name"      = aws_scheduler_schedule_group.default.name
+      "idle_reaper_enabled"       = tostring(var.idle_reaper_enabled)
+      "shutdown_lambda_arn"       = module.shutdown_sandbox_lambda.lambda_arn
+      "scheduler_role_arn"        = aws_iam_role.scheduler_role_invoke_shutdown_lambda.arn
   }
 
   log_group_name = aws_cloudwatch_log_group.restart_sandbox_lambda.name
@@ -352,10 +417,11 @@ module "monitor_sandbox_lambda" {
   lambda_name             = "monitor-sandbox"
   lambda_source_file_path = "lambdas/monitor-sandbox/lambda_function.py"
   lambda_output_file_path = "lambdas/monitor-sandbox/lambda_function.zip"
+  lambda_layer_arns       = [aws_lambda_layer_version.shared.arn]
   lambda_dependencies_zip_path = "lambdas/monitor-sandbox/python.zip"
 
   lambda_runtime = "python3.9"
-  lambda_timeout = 20
+  lambda_timeout = 60  # one run reconciles the whole fleet
 
   lambda_in_vpc = false
 
@@ -367,6 +433,7 @@ module "monitor_sandbox_lambda" {
         "Effect" : "Allow",
         "Action" : [
           "ecs:UpdateService",
+          "ecs:DescribeServices"
         ],
         "Resource" : [
           "arn:aws:ecs:${var.region}:${local.account_id}:service/${var.company_prefix}-*",
@@ -392,7 +459,8 @@ module "monitor_sandbox_lambda" {
         "Effect" : "Allow",
         "Action" : [
           "dynamodb:UpdateItem",
-          "dynamodb:GetItem"
+          "dynamodb:GetItem",
+          "dynamodb:Scan"
         ],
         "Resource" : "arn:aws:dynamodb:${var.region}:${local.account_id}:table/${aws_dynamodb_table.metadata_table.name}"
       },
@@ -447,11 +515,210 @@ module "monitor_sandbox_lambda" {
   log_group_name = aws_cloudwatch_log_group.monitor_sandbox_lambda.name
 }
 
+/* Lambda for pre-warming sandboxes ahead of their usual use */
+
+module "prewarm_sandbox_lambda" {
+  source = "./modules/lambda"
+
+  prefix = var.company_prefix
+
+  lambda_name             = "prewarm-sandbox"
+  lambda_source_file_path = "lambdas/prewarm-sandbox/lambda_function.py"
+  lambda_output_file_path = "lambdas/prewarm-sandbox/lambda_function.zip"
+  lambda_layer_arns       = [aws_lambda_layer_version.shared.arn]
+  lambda_dependencies_zip_path = "lambdas/prewarm-sandbox/python.zip"
+
+  lambda_runtime = "python3.10"
+  lambda_timeout = 60  # waits on the Logs Insights activity query
+
+  lambda_in_vpc = false
+
+  lambda_role_execution_policy = jsonencode({
+    "Version" : "2012-10-17",
+    "Statement" : [
+      {
+        "Sid" : "CloudWatchAccessLogsQuery",
+        "Effect" : "Allow",
+        "Action" : [
+          "logs:StartQuery"
+        ],
+        "Resource" : [
+          "arn:aws:logs:${var.region}:${local.account_id}:log-group:${aws_cloudwatch_log_group.ecs_access_logs.name}:*",
+          "arn:aws:logs:${var.region}:${local.account_id}:log-group:${aws_cloudwatch_log_group.ecs_access_logs.name}"
+        ]
+      },
+      {
+        "Sid" : "CloudWatchQueryResults",
+        "Effect" : "Allow",
+        "Action" : [
+          "logs:GetQueryResults",
+          "logs:StopQuery"
+        ],
+        "Resource" : "*"
+      },
+      {
+        "Sid" : "DynamoDB",
+        "Effect" : "Allow",
+        "Action" : [
+          "dynamodb:Scan"
+        ],
+        "Resource" : "arn:aws:dynamodb:${var.region}:${local.account_id}:table/${aws_dynamodb_table.metadata_table.name}"
+      },
+      {
+        "Sid" : "InvokeStartupLambda",
+        "Effect" : "Allow",
+        "Action" : "lambda:InvokeFunction",
+        "Resource" : module.restart_sandbox_lambda.lambda_arn
+      },
+      {
+        "Sid" : "AWSLambdaVPCAccessExecutionPermissions",
+        "Effect" : "Allow",
+        "Action" : [
+          "logs:CreateLogGroup",
+          "logs:CreateLogStream",
+          "logs:PutLogEvents"
+        ],
+        "Resource" : [
+          aws_cloudwatch_log_group.prewarm_sandbox_lambda.arn,
+          "${aws_cloudwatch_log_group.prewarm_sandbox_lambda.arn}:log-stream:*"
+        ]
+      },
+      jsondecode(file("${path.module}/templates/iam_policies/xray.json"))
+    ]
+  })
+
+  environment_variables = {
+      "company_prefix"            = var.company_prefix
+      "metadata_ddb_table"        = aws_dynamodb_table.metadata_table.name
+      "ecs_access_log_group_name" = aws_cloudwatch_log_group.ecs_access_logs.name
+      "restart_lambda_arn"        = module.restart_sandbox_lambda.lambda_arn
+      "prewarm_max_concurrent"    = tostring(var.prewarm_max_concurrent)
+  }
+
+  log_group_name = aws_cloudwatch_log_group.prewarm_sandbox_lambda.name
+}
+
 # attach layer
 
 
 
 
+/* Lambda deleting sandboxes and sweeping idle ones */
+
+module "deprovision_sandbox_lambda" {
+  source = "./modules/lambda"
+
+  prefix = var.company_prefix
+
+  lambda_name             = "deprovision-sandbox"
+  lambda_source_file_path = "lambdas/deprovision-sandbox/lambda_function.py"
+  lambda_output_file_path = "lambdas/deprovision-sandbox/lambda_function.zip"
+  lambda_layer_arns       = [aws_lambda_layer_version.shared.arn]
+  lambda_dependencies_zip_path = "lambdas/deprovision-sandbox/python.zip"
+
+  lambda_runtime = "python3.10"
+  lambda_timeout = 300  # garbage collection sweeps tear down many sandboxes per invocation
+
+  lambda_in_vpc = false
+
+  lambda_role_execution_policy = jsonencode({
+    "Version" : "2012-10-17",
+    "Statement" : [
+      {
+        "Sid" : "ECS",
+        "Effect" : "Allow",
+        "Action" : [
+          "ecs:DeleteService"
+        ],
+        "Resource" : [
+          "arn:aws:ecs:${var.region}:${local.account_id}:service/${var.company_prefix}-*",
+          "arn:aws:ecs:${var.region}:${local.account_id}:service/demo-sandbox-system-sandbox-cluster/demo-sandbox-system-*"
+        ]
+      },
+      {
+        "Sid" : "ECSTaskDefinitions",
+        "Effect" : "Allow",
+        "Action" : [
+          "ecs:DeregisterTaskDefinition",
+          "ecs:DeleteTaskDefinitions"
+        ],
+        "Resource" : "*"
+      },
+      {
+        "Sid" : "CloudMap",
+        "Effect" : "Allow",
+        "Action" : [
+          "servicediscovery:ListInstances",
+          "servicediscovery:DeregisterInstance",
+          "servicediscovery:DeleteService"
+        ],
+        "Resource" : [
+          "arn:aws:servicediscovery:${var.region}:${local.account_id}:service/*",
+          "arn:aws:servicediscovery:${var.region}:${local.account_id}:namespace/${aws_service_discovery_http_namespace.main_api_namespace.id}"
+        ]
+      },
+      {
+        "Sid" : "EventBridgeDeleteSchedule",
+        "Effect" : "Allow",
+        "Action" : [
+          "scheduler:DeleteSchedule"
+        ],
+        "Resource" : "arn:aws:scheduler:${var.region}:${local.account_id}:schedule/${aws_scheduler_schedule_group.default.name}/*"
+      },
+      {
+        "Sid" : "AccessLogStreams",
+        "Effect" : "Allow",
+        "Action" : [
+          "logs:DeleteLogStream"
+        ],
+        "Resource" : "arn:aws:logs:${var.region}:${local.account_id}:log-group:${aws_cloudwatch_log_group.ecs_access_logs.name}:log-stream:*"
+      },
+      {
+        "Sid" : "DynamoDB",
+        "Effect" : "Allow",
+        "Action" : [
+          "dynamodb:GetItem",
+          "dynamodb:PutItem",
+          "dynamodb:UpdateItem",
+          "dynamodb:DeleteItem",
+          "dynamodb:Scan",
+          "dynamodb:Query"
+        ],
+        "Resource" : [
+          "arn:aws:dynamodb:${var.region}:${local.account_id}:table/${aws_dynamodb_table.metadata_table.name}",
+          "arn:aws:dynamodb:${var.region}:${local.account_id}:table/${aws_dynamodb_table.metadata_table.name}/index/DomainIndex"
+        ]
+      },
+      {
+        "Sid" : "AWSLambdaVPCAccessExecutionPermissions",
+        "Effect" : "Allow",
+        "Action" : [
+          "logs:CreateLogGroup",
+          "logs:CreateLogStream",
+          "logs:PutLogEvents"
+        ],
+        "Resource" : [
+          aws_cloudwatch_log_group.deprovision_sandbox_lambda.arn,
+          "${aws_cloudwatch_log_group.deprovision_sandbox_lambda.arn}:log-stream:*"
+        ]
+      },
+      jsondecode(file("${path.module}/templates/iam_policies/xray.json"))
+    ]
+  })
+
+  environment_variables = {
+      "company_prefix"            = var.company_prefix
+      "domain"                    = var.domain
+      "metadata_ddb_table"        = aws_dynamodb_table.metadata_table.name
+      "ecs_cluster_arn"           = aws_ecs_cluster.main.arn
+      "ecs_access_log_group_name" = aws_cloudwatch_log_group.ecs_access_logs.name
+      "scheduler_group_name"      = aws_scheduler_schedule_group.default.name
+      "gc_retention_days"         = tostring(var.gc_retention_days)
+  }
+
+  log_group_name = aws_cloudwatch_log_group.deprovision_sandbox_lambda.name
+}
+
 # Lambda proxy-request normal requests to their respective ECS service
 
 module "proxy_request_lambda" {
@@ -462,6 +729,7 @@ module "proxy_request_lambda" {
   lambda_name             = "proxy-request"
   lambda_source_file_path = "lambdas/proxy-request/lambda_function.py"
   lambda_output_file_path = "lambdas/proxy-request/lambda_function.zip"
+  lambda_layer_arns       = [aws_lambda_layer_version.shared.arn]
   lambda_dependencies_zip_path = "lambdas/proxy-request/python.zip"
 
   lambda_runtime = "python3.10"
@@ -528,6 +796,7 @@ module "proxy_request_lambda" {
         "Effect" : "Allow",
         "Action" : [
           "dynamodb:GetItem",
+          "dynamodb:UpdateItem",
           "dynamodb:Query"
         ],
         "Resource" : [
@@ -567,6 +836,7 @@ module "proxy_request_lambda" {
       "metadata_ddb_table_name"   = aws_dynamodb_table.metadata_table.name
       "full_domain"               = var.domain
       "startup_task_lambda_arn"   = module.restart_sandbox_lambda.lambda_arn
+      "response_cache_enabled"    = tostring(var.response_cache_enabled)
     }
 
   log_group_name = aws_cloudwatch_log_group.proxy_request_lambda.name
@@ -0,0 +1,330 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sandbox_shared.clients import lazy_client
+from sandbox_shared.metrics import metrics
+from sandbox_shared.schedules import schedule_name
+from sandbox_shared.store import SandboxStore
+from os import environ
+from datetime import datetime
+
+ecs = lazy_client('ecs')
+ddb = lazy_client('dynamodb')
+cloudmap = lazy_client('servicediscovery')
+scheduler = lazy_client('scheduler')
+cloudwatch_logs = lazy_client('logs')
+store = SandboxStore(ddb, environ.get("metadata_ddb_table"))
+
+company_prefix = environ.get("company_prefix")
+ecs_access_log_group_name = environ.get("ecs_access_log_group_name")
+gc_retention_days = int(environ.get("gc_retention_days", "14"))
+gc_max_sandboxes = int(environ.get("gc_max_sandboxes", "50"))
+gc_max_workers = int(environ.get("gc_max_workers", "4"))
+# how long a teardown waits for CloudMap to finish deregistering the instances of a stopping sandbox
+cloudmap_delete_timeout_seconds = int(environ.get("cloudmap_delete_timeout_seconds", "120"))
+
+# task_status of a sandbox whose resources are being deleted, a sweep retries it until the row is gone
+DELETING = "DELETING"
+TEARDOWN_ATTRIBUTES = [
+    "uuid", "domain", "deprovisioned_domain", "service_arn", "cloudmap_service_arn", "task_definition_arn"
+]
+GC_ATTRIBUTES = ["uuid", "domain", "task_status", "desired_tasks", "pool_slot", "last_activity_at", "updated_at", "created_at"]
+
+
+def delete_ecs_service(service_arn):
+    try:
+        ecs.delete_service(cluster=environ.get("ecs_cluster_arn"), service=service_arn, force=True)
+    except (ecs.exceptions.ServiceNotFoundException, ecs.exceptions.ServiceNotActiveException):
+        pass
+
+
+def deregister_instances(service_id):
+    paginator = cloudmap.get_paginator("list_instances")
+    for page in paginator.paginate(ServiceId=service_id):
+        for instance in page.get("Instances", []):
+            try:
+                cloudmap.deregister_instance(ServiceId=service_id, InstanceId=instance["Id"])
+            except (cloudmap.exceptions.InstanceNotFound, cloudmap.exceptions.DuplicateRequest):
+                pass  # already gone or being deregistered
+
+
+def delete_cloudmap_service(cloudmap_service_arn):
+    """Deregister whatever ECS left registered and delete the CloudMap service.
+
+    CloudMap refuses the delete with ResourceInUse while deregistrations are in progress, which takes a
+    while for a sandbox whose tasks are still stopping, so this retries for up to
+    cloudmap_delete_timeout_seconds before giving up and leaving it to the next sweep.
+    """
+    service_id = cloudmap_service_arn.rsplit("/", 1)[-1]
+    deadline = time.monotonic() + cloudmap_delete_timeout_seconds
+    delay = 1
+    while True:
+        try:
+            deregister_instances(service_id)
+            cloudmap.delete_service(Id=service_id)
+            return
+        except cloudmap.exceptions.ServiceNotFound:
+            return
+        except cloudmap.exceptions.ResourceInUse:
+            if time.monotonic() + delay > deadline:
+                raise
+        time.sleep(delay)
+        delay = min(delay * 2, 10)
+
+
+def remove_service(sandbox):
+    # ECS registers the service's tasks in CloudMap, so the ECS service goes first
+    if sandbox.service_arn:
+        delete_ecs_service(sandbox.service_arn)
+    if sandbox.cloudmap_service_arn:
+        delete_cloudmap_service(sandbox.cloudmap_service_arn)
+
+
+def own_task_definition(sandbox):
+    """The sandbox's task definition when it has a family of its own, None for a shared content-addressed one.
+
+    Sandboxes provisioned before task definitions were shared registered a ``{company_prefix}-{uuid}`` family.
+    """
+    if not sandbox.task_definition_arn:
+        return None
+    family = sandbox.task_definition_arn.rsplit("/", 1)[-1].rsplit(":", 1)[0]
+    return sandbox.task_definition_arn if family == f"{company_prefix}-{sandbox.uuid}" else None
+
+
+def delete_task_definition(task_definition_arn):
+    try:
+        ecs.deregister_task_definition(taskDefinition=task_definition_arn)
+    except ecs.exceptions.ClientException as e:
+        print(f"Task definition {task_definition_arn} not deregistered, it is gone or already inactive: {e!r}")
+
+    response = ecs.delete_task_definitions(taskDefinitions=[task_definition_arn])
+    for failure in response.get("failures", []):
+        if failure.get("reason") != "TASK_DEFINITION_NOT_FOUND":
+            raise RuntimeError(f"Could not delete {task_definition_arn}: {failure}")
+
+
+def delete_shutdown_schedule(service_uuid):
+    try:
+        scheduler.delete_schedule(Name=schedule_name(service_uuid), GroupName=environ.get("scheduler_group_name", ""))
+    except scheduler.exceptions.ResourceNotFoundException:
+        pass
+
+
+def delete_access_log_stream(service_uuid):
+    try:
+        cloudwatch_logs.delete_log_stream(logGroupName=ecs_access_log_group_name, logStreamName=service_uuid)
+    except cloudwatch_logs.exceptions.ResourceNotFoundException:
+        pass
+
+
+def hold_domain(domain, service_uuid):
+    """Make sure the domain is claimed while its sandbox is torn down, sandboxes older than domain claims have none."""
+    try:
+        store.claim_domain(domain, service_uuid)
+    except store.client.exceptions.ConditionalCheckFailedException:
+        pass  # already claimed, by this sandbox
+
+
+def teardown(service_uuid, condition="attribute_exists(#uuid)", **condition_values):
+    """Delete every resource of a sandbox and then its metadata row, returns the steps that failed.
+
+    The row is first marked DELETING and loses its domain and is_running, so nothing routes to, wakes
+    or reaps the sandbox while it is torn down. The domain stays claimed by the DELETING row until the
+    row is deleted, so a new provision of the PR gets a 409 instead of reusing the CloudMap service
+    named after the domain while this one still deletes it. A failed step leaves the row in place for
+    the next sweep to retry. Shared task definitions are left alone, only a per-sandbox family is deleted.
+    """
+    sandbox = store.get(service_uuid, TEARDOWN_ATTRIBUTES, consistent=True)
+    if not sandbox:
+        return []
+
+    domain = sandbox.domain or sandbox.deprovisioned_domain
+    if sandbox.domain:
+        hold_domain(sandbox.domain, service_uuid)
+
+    update = store.update(service_uuid).set(
+        task_status=DELETING,
+        desired_tasks=0,
+        updated_at=datetime.now().isoformat()
+    ).remove("domain", "is_running", "pool_slot")
+    if domain:
+        update.set(deprovisioned_domain=domain)
+    update.commit(condition=condition, **condition_values)
+
+    steps = {
+        "service": lambda: remove_service(sandbox),
+        "shutdown schedule": lambda: delete_shutdown_schedule(service_uuid),
+        "access log stream": lambda: delete_access_log_stream(service_uuid),
+    }
+    task_definition_arn = own_task_definition(sandbox)
+    if task_definition_arn:
+        steps["task definition"] = lambda: delete_task_definition(task_definition_arn)
+    failed = []
+    with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        futures = {name: executor.submit(step) for name, step in steps.items()}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error deleting {name} of {service_uuid}: {e!r}")
+                failed.append(name)
+
+    if not failed:
+        store.delete(service_uuid)
+        if domain:
+            store.release_domain(domain, service_uuid)
+        print(f"Deprovisioned {service_uuid}")
+    return failed
+
+
+def last_active(sandbox):
+    """Epoch seconds of the sandbox's last recorded activity, None when the row has no timestamp at all."""
+    if sandbox.last_activity_at:
+        return sandbox.last_activity_at
+    for recorded in (sandbox.updated_at, sandbox.created_at):
+        try:
+            return int(datetime.fromisoformat(recorded).timestamp())
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def gc_candidates(cutoff):
+    """Stopped sandboxes idle since before cutoff and unfinished teardowns, oldest first.
+
+    Warm pool slots are never collected, they are idle by design.
+    """
+    candidates = []
+    for sandbox in store.scan(GC_ATTRIBUTES):
+        if sandbox.pool_slot:
+            continue
+        active = last_active(sandbox)
+        if sandbox.task_status == DELETING or (sandbox.desired_tasks == 0 and active is not None and active < cutoff):
+            candidates.append((active or 0, sandbox))
+
+    candidates.sort(key=lambda candidate: candidate[0])
+    return [sandbox for active, sandbox in candidates]
+
+
+def collect(sandbox, cutoff, context=None):
+    """Tear down a GC candidate, None when too little of the invocation is left to wait for its CloudMap service."""
+    if context and context.get_remaining_time_in_millis() < (cloudmap_delete_timeout_seconds + 30) * 1000:
+        return None
+    if sandbox.task_status == DELETING:
+        return teardown(sandbox.uuid, condition="#task_status = :deleting", deleting=DELETING)
+    # a sandbox woken since the scan keeps its resources
+    return teardown(
+        sandbox.uuid,
+        condition="#desired_tasks = :stopped AND (attribute_not_exists(#last_activity_at) OR #last_activity_at < :cutoff)"
+                  " AND attribute_not_exists(#pool_slot)",
+        stopped=0,
+        cutoff=cutoff
+    )
+
+
+def garbage_collect(dry_run, context=None):
+    """Tear down sandboxes idle for longer than gc_retention_days, at most gc_max_sandboxes per sweep.
+
+    A dry run only reports what a sweep would delete. Sandboxes the invocation has no time left for are
+    deferred to the next sweep.
+    """
+    now = int(time.time())
+    cutoff = now - gc_retention_days * 86400
+    candidates = gc_candidates(cutoff)
+    selected = candidates[:gc_max_sandboxes]
+
+    report = [
+        {
+            "service_uuid": sandbox.uuid,
+            "domain": sandbox.domain,
+            "task_status": sandbox.task_status,
+            "idle_days": round((now - last_active(sandbox)) / 86400, 1) if last_active(sandbox) else None
+        }
+        for sandbox in selected
+    ]
+
+    deleted, skipped, deferred, failed = 0, 0, 0, 0
+    if not dry_run and selected:
+        with ThreadPoolExecutor(max_workers=gc_max_workers) as executor:
+            futures = [executor.submit(collect, sandbox, cutoff, context) for sandbox in selected]
+            for future, entry in zip(futures, report):
+                try:
+                    failed_steps = future.result()
+                except store.client.exceptions.ConditionalCheckFailedException:
+                    entry["skipped"] = True
+                    skipped += 1
+                    continue
+                except Exception as e:
+                    print(f"Error deprovisioning {entry['service_uuid']}: {e!r}")
+                    failed_steps = ["metadata"]
+                if failed_steps is None:
+                    entry["deferred"] = True
+                    deferred += 1
+                    continue
+                entry["failed_steps"] = failed_steps
+                if failed_steps:
+                    failed += 1
+                else:
+                    deleted += 1
+
+    print(
+        f"{'Dry run: ' if dry_run else ''}{len(candidates)} sandboxes idle for over {gc_retention_days} days, "
+        f"{len(selected)} selected, {deleted} deleted, {skipped} skipped, {deferred} deferred, "
+        f"{failed} failed"
+    )
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "dry_run": dry_run,
+            "retention_days": gc_retention_days,
+            "candidates": len(candidates),
+            "deleted": deleted,
+            "skipped": skipped,
+            "deferred": deferred,
+            "failed": failed,
+            "sandboxes": report
+        })
+    }
+
+
+@metrics.instrument_handler
+def lambda_handler(event, context):
+    """Tear down one sandbox, given by service_uuid or by its PR, or sweep idle sandboxes with ``{"gc": true}``.
+
+    ``{"gc": true, "dry_run": true}`` reports the sandboxes a sweep would delete without touching them.
+    """
+    if event.get("gc"):
+        return garbage_collect(bool(event.get("dry_run")), context)
+
+    service_uuid = event.get("service_uuid")
+    if not service_uuid and all(k in event for k in ("pr", "repository", "user")):
+        service_uuid = store.find_uuid_by_domain(
+            f"{event['pr']}-{event['repository']}-{event['user']}.gh.{environ.get('domain')}"
+        )
+        if not service_uuid:
+            return {
+                "statusCode": 404,
+                "body": json.dumps({
+                    "message": "no sandbox for this PR"
+                })
+            }
+
+    if not service_uuid:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({
+                "message": "missing service_uuid"
+            })
+        }
+
+    failed = teardown(service_uuid)
+
+    return {
+        "statusCode": 500 if failed else 200,
+        "body": json.dumps({
+            "message": f"failed to delete {', '.join(failed)}" if failed else "deprovisioned",
+            "service_uuid": service_uuid
+        })
+    }
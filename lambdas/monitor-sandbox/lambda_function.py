@@ -1,135 +1,152 @@
 import json
-import time
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
+from sandbox_shared.clients import lazy_client
+from sandbox_shared.metrics import metrics
+from sandbox_shared.store import SandboxStore
 from os import environ
-from datetime import timedelta, datetime
+from datetime import datetime
 
-ecs = boto3.client('ecs')
-ddb = boto3.client('dynamodb')
-cloudmap = boto3.client('servicediscovery')
-scheduler = boto3.client('scheduler')
-cloudwatch_logs = boto3.client('logs')
+ecs = lazy_client('ecs')
+ddb = lazy_client('dynamodb')
+store = SandboxStore(ddb, environ.get("metadata_ddb_table"))
 
 company_prefix = environ.get("company_prefix")
+reconcile_max_workers = int(environ.get("reconcile_max_workers", "16"))
 
+# ecs.describe_services accepts at most 10 services per call
+DESCRIBE_SERVICES_CHUNK = 10
+RECONCILED_ATTRIBUTES = ["uuid", "service_arn", "task_status", "desired_tasks", "running_tasks"]
 
-def update_schedule(schedule_name: str, new_properties: dict):
-    existing_schedule = scheduler.get_schedule(
-        GroupName=environ.get("scheduler_group_name"),
-        Name=schedule_name
-    )
 
-    filtered_resp = {
-        k: v
-        for k, v in existing_schedule.items()
-        if k not in ["ResponseMetadata", "Arn", "CreationDate", "LastModificationDate"]
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
-    }
 
-    merged_response = filtered_resp | new_properties
+def load_sandboxes(service_uuid=None):
+    """Every metadata row with an ECS service that is not being deleted, or only the given sandbox."""
+    if service_uuid:
+        sandbox = store.get(service_uuid, RECONCILED_ATTRIBUTES)
+        sandboxes = [sandbox] if sandbox else []
+    else:
+        sandboxes = store.scan(RECONCILED_ATTRIBUTES)
 
-    scheduler_schedule = scheduler.update_schedule(**merged_response)
+    # deprovision-sandbox owns rows it is tearing down, their services are expected to go missing
+    return [sandbox for sandbox in sandboxes if sandbox.service_arn and sandbox.task_status != "DELETING"]
 
-    return scheduler_schedule
 
-def lambda_handler(event, context):
-    service_uuid = event["service_uuid"]
-
-    dynamo_row = ddb.get_item(
-        TableName=environ.get("metadata_ddb_table"),
-        Key={
-            "uuid": {
-                "S": service_uuid
-            }
-        }
-    )
+def describe_services(service_arns):
+    """Service ARN -> ECS service description (None when ECS no longer knows it), 10 ARNs per call in parallel."""
+    def describe_chunk(chunk):
+        response = ecs.describe_services(cluster=environ.get("ecs_cluster_arn"), services=chunk)
+        described = {service["serviceArn"]: service for service in response.get("services", [])}
+        for failure in response.get("failures", []):
+            if failure.get("reason") == "MISSING":
+                described[failure["arn"]] = None
+            else:
+                print(f"Could not describe {failure.get('arn')}: {failure.get('reason')}")
+        return described
 
-    if not dynamo_row.get("Item"):
-        print("No metadata found for service_uuid")
-        return {
-            "statusCode": 404,
-            "body": json.dumps({
-                "message": "No metadata found for service_uuid"
-            })
-        }
-
-    now = int(time.time() * 1000)  # Current time in milliseconds
-    ten_minutes_ago = now - 600000  # 10 minutes in milliseconds
+    services = {}
+    with ThreadPoolExecutor(max_workers=reconcile_max_workers) as executor:
+        for described in executor.map(describe_chunk, list(chunked(service_arns, DESCRIBE_SERVICES_CHUNK))):
+            services.update(described)
+    return services
 
-    # Query CloudWatch logs
-    response = cloudwatch_logs.filter_log_events(
-        logGroupName=environ.get("ecs_access_log_group_name"),
-        logStreamNames=[service_uuid],
-        startTime=ten_minutes_ago,
-        endTime=now,
-        limit=1
-    )
 
-    print(response)
+def observed_state(service):
+    """task_status, desired and running count of the sandbox as ECS sees it."""
+    if service is None or service["status"] == "INACTIVE":
+        return "MISSING", 0, 0
 
-    # Check if there are events
-    if response.get("events") and not event.get("force_shutdown"):
-        print("Service is still being used")
+    desired, running = service["desiredCount"], service["runningCount"]
+    if desired == 0:
+        status = "STOPPED" if running == 0 else "STOPPING"
+    else:
+        status = "ACTIVE" if running >= desired else "STARTING"
+    return status, desired, running
 
-        update_schedule(f"{company_prefix}-{service_uuid}", {
-            "ScheduleExpression": f"at({(datetime.now() + timedelta(minutes=10)).strftime('%Y-%m-%dT%H:%M:%S')})",
-            "FlexibleTimeWindow": {
-                "Mode": "OFF"
-            }
-        })
 
-        return {
-            "statusCode": 400,
-            "body": json.dumps({
-                "message": "Service is still being used so is not shutting down"
-            })
-        }
+def unchanged_condition(name, value):
+    return f"#{name} = :read_{name}" if value is not None else f"attribute_not_exists(#{name})"
 
-    service_arn = dynamo_row["Item"]["service_arn"]["S"]
 
-    update_response = ecs.update_service(
-        cluster=environ.get("ecs_cluster_arn"),
-        service=service_arn,
-        desiredCount=0
-    )
+def write_state(sandbox, status, desired, running, reconciled_at):
+    """Write what ECS reported, unless the row changed since it was read.
 
-    ddb.update_item(
-        TableName=environ.get("metadata_ddb_table"),
-        Key={
-            "uuid": {
-                "S": service_uuid
-            }
-        },
-        UpdateExpression="SET desired_tasks = :desired_tasks",
-        ExpressionAttributeValues={
-            ":desired_tasks": {
-                "N": "0"
-            }
-        }
+    A restart, a warm pool claim or a deprovision (DELETING, which load_sandboxes never returns) that
+    lands while the sweep runs is newer than the ECS snapshot and wins, the next run reconciles it.
+    """
+    condition_values = {
+        f"read_{name}": getattr(sandbox, name)
+        for name in ("task_status", "desired_tasks") if getattr(sandbox, name) is not None
+    }
+    store.update(sandbox.uuid).set(
+        task_status=status, desired_tasks=desired, running_tasks=running, reconciled_at=reconciled_at
+    ).commit(
+        # also never recreates a row that was deleted while the sweep ran
+        condition=f"attribute_exists(#uuid) AND {unchanged_condition('task_status', sandbox.task_status)}"
+                  f" AND {unchanged_condition('desired_tasks', sandbox.desired_tasks)}",
+        **condition_values
     )
 
 
-    if dynamo_row["Item"].get("shutdown_schedule_arn"):
-        existing_schedule = scheduler.get_schedule(
-            GroupName=environ.get("scheduler_group_name"),
-            Name=f"{company_prefix}-{service_uuid}"
-        )
-
-        filtered_resp = {
-            k: v
-            for k, v in existing_schedule.items()
-            if k not in ["ResponseMetadata", "Arn", "CreationDate", "LastModificationDate"]
-
+@metrics.instrument_handler
+def lambda_handler(event, context):
+    """Reconcile task_status, desired_tasks and running_tasks in the metadata table with ECS.
+
+    Runs over the whole fleet for the scheduled ``{}`` event, or a single sandbox when the event carries a
+    service_uuid. Only rows that drifted from ECS are written back. Any other event, like a request through
+    the public manage endpoint, is rejected before it can trigger a fleet-wide sweep.
+    """
+    event = event or {}
+    service_uuid = event.get("service_uuid")
+    if not service_uuid and event:
+        print(f"Rejecting unexpected event with keys {sorted(event)}")
+        return {
+            "statusCode": 400,
+            "body": json.dumps({
+                "message": "expected an empty event or a service_uuid"
+            })
         }
 
-        merged_response = filtered_resp | {"State": "DISABLED"}
-
-        scheduler_schedule = scheduler.update_schedule(**merged_response)
+    sandboxes = load_sandboxes(service_uuid)
+    services = describe_services([sandbox.service_arn for sandbox in sandboxes])
+
+    changes = []
+    for sandbox in sandboxes:
+        if sandbox.service_arn not in services:
+            continue  # describe failed for another reason, try again on the next run
+
+        status, desired, running = observed_state(services[sandbox.service_arn])
+        if (sandbox.task_status, sandbox.desired_tasks, sandbox.running_tasks) != (status, desired, running):
+            changes.append((sandbox, status, desired, running))
+
+    reconciled_at = datetime.now().isoformat()
+    failed, superseded = 0, 0
+    with ThreadPoolExecutor(max_workers=reconcile_max_workers) as executor:
+        futures = [executor.submit(write_state, *change, reconciled_at) for change in changes]
+        for future, change in zip(futures, changes):
+            try:
+                future.result()
+            except store.client.exceptions.ConditionalCheckFailedException:
+                superseded += 1
+            except Exception as e:
+                print(f"Error updating {change[0].uuid}: {e!r}")
+                failed += 1
+
+    print(
+        f"Reconciled {len(sandboxes)} sandboxes, {len(changes)} drifted, {superseded} changed during the run, "
+        f"{failed} updates failed"
+    )
 
     return {
         "statusCode": 200,
         "body": json.dumps({
-            "message": "Service shutdown successfully"
+            "sandboxes": len(sandboxes),
+            "updated": len(changes) - failed - superseded,
+            "superseded": superseded,
+            "failed": failed
         })
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,173 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sandbox_shared.clients import lazy_client
+from sandbox_shared.metrics import metrics
+from sandbox_shared.store import SandboxStore
+from os import environ
+from datetime import datetime, timedelta, timezone
+
+logs = lazy_client('logs')
+lambda_client = lazy_client('lambda')
+ddb = lazy_client('dynamodb')
+store = SandboxStore(ddb, environ.get("metadata_ddb_table"))
+
+restart_lambda_arn = environ.get("restart_lambda_arn")
+ecs_access_log_group_name = environ.get("ecs_access_log_group_name")
+prewarm_lookback_days = int(environ.get("prewarm_lookback_days", "21"))
+prewarm_threshold = float(environ.get("prewarm_threshold", "0.5"))
+prewarm_max_concurrent = int(environ.get("prewarm_max_concurrent", "10"))
+prewarm_query_timeout_seconds = float(environ.get("prewarm_query_timeout_seconds", "40"))
+
+# Logs Insights returns at most this many rows, one per sandbox and sampled day with activity
+INSIGHTS_MAX_RESULTS = 10000
+
+
+def next_slot(now):
+    """Start of the hour the planner warms sandboxes up for."""
+    return now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+
+
+def sample_days(slot, lookback_days):
+    """Start of the same hour on each of the previous lookback_days days, most recent first."""
+    return [slot - timedelta(days=day) for day in range(1, lookback_days + 1)]
+
+
+def to_millis(moment):
+    return int(moment.timestamp() * 1000)
+
+
+def run_activity_query(samples, deadline):
+    """Rows of one Logs Insights query over the sampled hours, one per sandbox and day with activity."""
+    windows = " or ".join(
+        f"(toMillis(@timestamp) >= {to_millis(start)} and toMillis(@timestamp) < {to_millis(start + timedelta(hours=1))})"
+        for start in samples
+    )
+    query_id = logs.start_query(
+        logGroupName=ecs_access_log_group_name,
+        startTime=int(samples[-1].timestamp()),
+        endTime=int((samples[0] + timedelta(hours=1)).timestamp()),
+        queryString=f"filter {windows} | stats count(*) as requests by @logStream, datefloor(@timestamp, 1h) as hour",
+        limit=INSIGHTS_MAX_RESULTS
+    )["queryId"]
+
+    while True:
+        response = logs.get_query_results(queryId=query_id)
+        if response["status"] == "Complete":
+            return response["results"]
+        if response["status"] not in ("Scheduled", "Running"):
+            raise RuntimeError(f"Activity query {query_id} ended as {response['status']}")
+        if time.monotonic() > deadline:
+            logs.stop_query(queryId=query_id)
+            raise TimeoutError(f"Activity query {query_id} did not finish in {prewarm_query_timeout_seconds}s")
+        time.sleep(1)
+
+
+def load_activity(samples, deadline=None):
+    """service uuid -> dates (YYYY-MM-DD) on which the sandbox received requests during the sampled hour.
+
+    proxy-request writes the access log of each sandbox to a log stream named after its uuid, so a single
+    Logs Insights query over the sampled hours gives the history of the whole fleet. A result at the
+    INSIGHTS_MAX_RESULTS cap may be truncated, the sampled hours are then split in halves and queried again.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + prewarm_query_timeout_seconds
+
+    results = run_activity_query(samples, deadline)
+    if len(results) >= INSIGHTS_MAX_RESULTS:
+        if len(samples) > 1:
+            middle = len(samples) // 2
+            activity = load_activity(samples[:middle], deadline)
+            for service_uuid, dates in load_activity(samples[middle:], deadline).items():
+                activity.setdefault(service_uuid, set()).update(dates)
+            return activity
+        print(f"Over {INSIGHTS_MAX_RESULTS} sandboxes active in the hour of {samples[0].isoformat()}, activity is truncated")
+
+    activity = {}
+    for row in results:
+        fields = {field["field"]: field["value"] for field in row}
+        # hour comes back as "YYYY-MM-DD HH:MM:SS.000" in UTC
+        activity.setdefault(fields["@logStream"], set()).add(fields["hour"][:10])
+    return activity
+
+
+def activity_probability(active_dates, slot, samples):
+    """Estimated chance the sandbox is used during slot, from its activity at the same time of day.
+
+    The share of sampled same weekdays with activity and the share of sampled days of the same kind
+    (weekday or weekend) are weighted equally, so a sandbox used every weekday morning qualifies on a
+    Monday it has history for and on one it does not.
+    """
+    def share(days):
+        return sum(day.strftime("%Y-%m-%d") in active_dates for day in days) / len(days) if days else 0
+
+    weekend = slot.weekday() >= 5
+    same_weekday = [day for day in samples if day.weekday() == slot.weekday()]
+    same_kind = [day for day in samples if (day.weekday() >= 5) == weekend]
+
+    if not same_weekday:
+        return share(same_kind)
+    return (share(same_weekday) + share(same_kind)) / 2
+
+
+def prewarm(service_uuid):
+    lambda_client.invoke(
+        FunctionName=restart_lambda_arn,
+        InvocationType='Event',
+        Payload=json.dumps({"service_uuid": service_uuid, "prewarm": True})
+    )
+
+
+@metrics.instrument_handler
+def lambda_handler(event, context):
+    """Start the stopped sandboxes that are likely to be used in the coming hour.
+
+    Runs shortly before every full hour. A sandbox whose prediction was wrong gets no requests and is shut
+    down again by the normal idle shutdown, which happens well within the hour, so at most
+    prewarm_max_concurrent pre-warmed sandboxes are up at any time.
+    """
+    slot = next_slot(datetime.now(timezone.utc))
+    # unclaimed warm pool slots are stopped too but serve nobody until provision-sandbox claims them,
+    # sandboxes being deprovisioned never run again
+    stopped = [
+        sandbox.uuid for sandbox in store.scan(["uuid", "desired_tasks", "task_status", "pool_slot"])
+        if sandbox.desired_tasks == 0 and not sandbox.pool_slot and sandbox.task_status != "DELETING"
+    ]
+
+    planned = []
+    if stopped and prewarm_max_concurrent > 0:
+        samples = sample_days(slot, prewarm_lookback_days)
+        with metrics.timer("ActivityQuery"):
+            activity = load_activity(samples)
+
+        candidates = sorted(
+            ((activity_probability(activity.get(service_uuid, set()), slot, samples), service_uuid) for service_uuid in stopped),
+            reverse=True
+        )
+        likely = [service_uuid for probability, service_uuid in candidates if probability >= prewarm_threshold]
+        planned = likely[:prewarm_max_concurrent]
+        if len(likely) > len(planned):
+            print(f"{len(likely) - len(planned)} likely sandboxes over the pre-warm budget of {prewarm_max_concurrent}")
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(len(planned), 1)) as executor:
+        futures = [executor.submit(prewarm, service_uuid) for service_uuid in planned]
+        for future, service_uuid in zip(futures, planned):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error pre-warming {service_uuid}: {e!r}")
+                failed += 1
+
+    print(f"Pre-warming {len(planned) - failed} of {len(stopped)} stopped sandboxes for {slot.isoformat()}")
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "slot": slot.isoformat(),
+            "stopped": len(stopped),
+            "prewarmed": len(planned) - failed,
+            "failed": failed
+        })
+    }
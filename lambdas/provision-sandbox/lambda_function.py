@@ -1,78 +1,87 @@
+import hashlib
 import json
-import boto3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from sandbox_shared.clients import lazy_client
+from sandbox_shared.metrics import metrics
+from sandbox_shared.schedules import SCHEDULE_TIME_FORMAT, arm_shutdown_schedule, schedule_name, shutdown_schedule
+from sandbox_shared.store import POOL_AVAILABLE, RUNNING, Sandbox, SandboxStore
 from os import environ
 import uuid
 
 from datetime import timedelta, datetime
 
-ecs = boto3.client('ecs')
-ddb = boto3.client('dynamodb')
-cloudmap = boto3.client('servicediscovery')
-scheduler = boto3.client('scheduler')
-cloudwatch_logs = boto3.client('logs')
-
 company_prefix = environ.get("company_prefix")
+idle_reaper_enabled = environ.get("idle_reaper_enabled", "false").lower() == "true"
+warm_pool_size = int(environ.get("warm_pool_size", "0"))
+warm_pool_refill_workers = int(environ.get("warm_pool_refill_workers", "5"))
+# held by one refill at a time, longer than the Lambda timeout so a run never overlaps the next one
+warm_pool_refill_lease_seconds = int(environ.get("warm_pool_refill_lease_seconds", "180"))
+deprovision_lambda_arn = environ.get("deprovision_lambda_arn")
+provision_batch_concurrency = int(environ.get("provision_batch_concurrency", "4"))
+provision_batch_max_items = int(environ.get("provision_batch_max_items", "50"))
+# invocation time a batch keeps free before starting another provision, enough for one to finish or roll back
+provision_batch_time_margin_ms = int(environ.get("provision_batch_time_margin_ms", "45000"))
+# how long a provision holds its domain before writing the metadata row, longer than the Lambda timeout
+domain_claim_seconds = int(environ.get("domain_claim_seconds", "300"))
 
+REQUIRED_PARAMETERS = ("pr", "repository", "user", "created_by_user_id")
+# every provision in a batch (and each of its concurrent steps) shares one client per service, so the
+# connection pools are sized for the whole batch and adaptive retries rate limit all of it together
+# instead of every thread retrying throttled ECS and CloudMap calls on its own
+AWS_CONFIG = {
+    "max_pool_connections": max(10, max(provision_batch_concurrency, warm_pool_refill_workers) * 4),
+    "retries": {"mode": "adaptive", "max_attempts": 10}
+}
 
-def lambda_handler(event, context):
-    # todo: auth
+ecs = lazy_client('ecs', config=AWS_CONFIG)
+ddb = lazy_client('dynamodb', config=AWS_CONFIG)
+cloudmap = lazy_client('servicediscovery', config=AWS_CONFIG)
+scheduler = lazy_client('scheduler', config=AWS_CONFIG)
+cloudwatch_logs = lazy_client('logs', config=AWS_CONFIG)
+lambda_client = lazy_client('lambda')
+store = SandboxStore(ddb, environ.get("metadata_ddb_table"))
 
-    if not all(k in event for k in ("pr", "repository", "user", "created_by_user_id")):
-        print(event.get(k) for k in ("pr", "repository", "user", "created_by_user_id"))
-        return {
-            "statusCode": 400,
-            "body": json.dumps({
-                "message": "missing required parameters"
-            })
-        }
+# slots tried per claim, PoolIndex is eventually consistent and concurrent provisions race for the same slots
+POOL_CLAIM_CANDIDATES = 5
+# attributes a claim binds to a warm pool slot, removed again when the claim is rolled back
+CLAIMED_ATTRIBUTES = (
+    "domain", "pr", "repository", "user", "created_by_user_id", "registry", "last_activity_at", "next_shutdown_at",
+    "is_running", "shutdown_schedule_arn"
+)
 
-    service_uuid = str(uuid.uuid4())
+# task definition content key -> ARN of a matching revision, kept across warm invocations
+task_definition_cache = {}
 
-    pull_request_number = event["pr"]
-    repository_name = event["repository"]
-    user = event["user"]
-    registry = "gh"
-    tld = environ.get("domain")
-    full_domain = f"{pull_request_number}-{repository_name}-{user}.{registry}.{tld}"
-
-    # store metadata
-    ddb.put_item(
-        TableName=environ.get("metadata_ddb_table"),
-        Item={
-            "uuid": {
-                "S": service_uuid
-            },
-            "created_by_user_id": {
-                "N": str(event["created_by_user_id"])
-            },
-            "pr": {
-                "N": str(event["pr"])
-            },
-            "repository": {
-                "S": event["repository"]
-            },
-            "user": {
-                "S": event["user"]
-            },
-            "task_status": {
-                "S": "pending"
-            },
-            "domain": {
-                "S": full_domain
-            },
-            "registry": {"S": "github"},
-            "created_at": {
-                "S": datetime.now().isoformat()
-            },
-            "updated_at": {
-                "S": datetime.now().isoformat()
-            }
-        }
-    )
 
+class Rollback:
+    """Undo actions for the resources a provisioning run created, run newest first when a later step fails."""
+
+    def __init__(self):
+        self._actions = []
+        self._lock = Lock()
+
+    def add(self, description, action):
+        with self._lock:
+            self._actions.append((description, action))
+
+    def run(self):
+        with self._lock:
+            actions, self._actions = self._actions, []
+
+        for description, action in reversed(actions):
+            print(f"Rolling back {description}")
+            try:
+                action()
+            except Exception as e:
+                print(f"Error rolling back {description}: {e!r}")
+
+
+def create_cloudmap_service(name, rollback):
     try:
         cloudmap_service = cloudmap.create_service(
-            Name=full_domain,
+            Name=name,
             NamespaceId=environ.get("cloudmap_namespace_id"),
             # DnsConfig={
             #     "NamespaceId": environ.get("cloudmap_namespace_id"),
@@ -89,24 +98,27 @@ def lambda_handler(event, context):
             #     ]
             # }
         )
-    except cloudmap.exceptions.ServiceAlreadyExists:
-        print("CloudMap already exists")
+    except cloudmap.exceptions.ServiceAlreadyExists as e:
+        # left over from an earlier sandbox for the domain, the error names the existing service
+        print(f"CloudMap service {e.response.get('ServiceId')} already exists for {name}")
 
         cloudmap_service = cloudmap.get_service(
-            Id=full_domain
+            Id=e.response["ServiceId"]
         )
+        return cloudmap_service["Service"]["Arn"]
 
-        print(cloudmap_service)
-
+    service_id = cloudmap_service["Service"]["Id"]
+    rollback.add("CloudMap service", lambda: cloudmap.delete_service(Id=service_id))
+    return cloudmap_service["Service"]["Arn"]
 
-    print(f"{company_prefix}-{service_uuid}")
 
-    ecs_task_definition = ecs.register_task_definition(
-        family=f"{company_prefix}-{service_uuid}",
-        taskRoleArn=environ.get("ecs_task_role_arn"),
-        executionRoleArn=environ.get("ecs_execution_role_arn"),
-        networkMode="awsvpc",
-        containerDefinitions=[
+def task_definition_spec():
+    """Everything register_task_definition gets except the family, the same for every sandbox today."""
+    return {
+        "taskRoleArn": environ.get("ecs_task_role_arn"),
+        "executionRoleArn": environ.get("ecs_execution_role_arn"),
+        "networkMode": "awsvpc",
+        "containerDefinitions": [
             {
                 "name": "sandbox",
                 "image": "nginxdemos/hello",  # todo integrate ECR/github artifcats image
@@ -139,42 +151,87 @@ def lambda_handler(event, context):
                 }
             }
         ],
-        runtimePlatform={
+        "runtimePlatform": {
             "cpuArchitecture": "X86_64",
             "operatingSystemFamily": "LINUX"
         },
-        requiresCompatibilities=[
+        "requiresCompatibilities": [
             "FARGATE"
         ],
-        cpu="256",
-        memory="512",
-        volumes=[],
-        placementConstraints=[]
+        "cpu": "256",
+        "memory": "512",
+        "volumes": [],
+        "placementConstraints": []
+    }
+
+
+def task_definition_key(spec):
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, separators=(",", ":")).encode()).hexdigest()[:16]
+
+
+def resolve_task_definition():
+    """ARN of a task definition revision for the current spec, only registered when no revision exists yet.
+
+    The family is named after a hash of the spec, so sandboxes with the same spec share one family and any
+    ACTIVE revision in it matches.
+    """
+    spec = task_definition_spec()
+    key = task_definition_key(spec)
+    if key in task_definition_cache:
+        return task_definition_cache[key]
+
+    family = f"{company_prefix}-td-{key}"
+    try:
+        task_definition = ecs.describe_task_definition(taskDefinition=family)
+    except ecs.exceptions.ClientException:
+        print(f"Registering task definition family {family}")
+        task_definition = ecs.register_task_definition(family=family, **spec)
+
+    task_definition_cache[key] = task_definition["taskDefinition"]["taskDefinitionArn"]
+    return task_definition_cache[key]
+
+
+def create_access_log_stream(service_uuid, rollback):
+    cloudwatch_logs.create_log_stream(
+        logGroupName=environ.get("ecs_access_log_group_name"),
+        logStreamName=f"{service_uuid}"
     )
+    rollback.add("access log stream", lambda: cloudwatch_logs.delete_log_stream(
+        logGroupName=environ.get("ecs_access_log_group_name"),
+        logStreamName=f"{service_uuid}"
+    ))
 
-    ddb.update_item(
-        TableName=environ.get("metadata_ddb_table"),
-        Key={
-            "uuid": {
-                "S": service_uuid
-            }
-        },
-        UpdateExpression="SET task_definition_arn = :task_definition_arn, cloudmap_service_arn = :cloudmap_service_arn",
-        ExpressionAttributeValues={
-            ":task_definition_arn": {
-                "S": ecs_task_definition["taskDefinition"]["taskDefinitionArn"]
-            },
-            ":cloudmap_service_arn": {
-                "S": cloudmap_service["Service"]["Arn"]
-            }
-        }
+
+def create_shutdown_schedule(service_uuid, at, rollback):
+    scheduler_schedule = scheduler.create_schedule(
+        **shutdown_schedule(service_uuid, at, environ.get("shutdown_lambda_arn", ""))
     )
+    rollback.add("shutdown schedule", lambda: scheduler.delete_schedule(
+        Name=schedule_name(service_uuid),
+        GroupName=environ.get("scheduler_group_name", "")
+    ))
+    return scheduler_schedule["ScheduleArn"]
+
+
+def sandbox_tags(service_uuid, event=None):
+    tags = {"company_prefix": company_prefix}
+    if event:
+        tags.update({
+            "pr": str(event["pr"]),
+            "repository": event["repository"],
+            "user": event["user"],
+            "created_by_user_id": str(event["created_by_user_id"])
+        })
+    tags["service_uuid"] = service_uuid
+    return [{"key": key, "value": value} for key, value in tags.items()]
 
+
+def create_ecs_service(service_uuid, tags, task_definition_arn, cloudmap_service_arn, rollback, desired_count=1):
     ecs_service = ecs.create_service(
         cluster=environ.get("ecs_cluster_arn"),
         serviceName=f"{company_prefix}-{service_uuid}",
-        taskDefinition=ecs_task_definition["taskDefinition"]["taskDefinitionArn"],
-        desiredCount=1,
+        taskDefinition=task_definition_arn,
+        desiredCount=desired_count,
         launchType="FARGATE",
         platformVersion="LATEST",
         networkConfiguration={
@@ -186,103 +243,432 @@ def lambda_handler(event, context):
         },
         serviceRegistries=[
             {
-                "registryArn": cloudmap_service["Service"]["Arn"],
+                "registryArn": cloudmap_service_arn,
                 # "port": 80,  # todo allow port config
                 "containerName": "sandbox",
                 # "containerPort": 80  # todo allow port config
             }
         ],
-        tags=[
-            {
-                "key": "company_prefix",
-                "value": company_prefix
-            },
-            {
-                "key": "pr",
-                "value": str(event["pr"])
-            },
-            {
-                "key": "repository",
-                "value": event["repository"]
-            },
-            {
-                "key": "user",
-                "value": event["user"]
-            },
-            {
-                "key": "created_by_user_id",
-                "value": str(event["created_by_user_id"])
-            },
-            {
-                "key": "service_uuid",
-                "value": service_uuid
-            }
-        ]
+        tags=tags
     )
 
-    # using environ.get("ecs_access_log_group_name")
+    service_arn = ecs_service["service"]["serviceArn"]
+    rollback.add("ECS service", lambda: ecs.delete_service(
+        cluster=environ.get("ecs_cluster_arn"),
+        service=service_arn,
+        force=True
+    ))
+    return service_arn
 
-    cloudwatch_logs.create_log_stream(
-        logGroupName=environ.get("ecs_access_log_group_name"),
-        logStreamName=f"{service_uuid}"
+
+def create_sandbox_resources(service_uuid, cloudmap_service_name, tags, rollback, desired_count=1, shutdown_at=None):
+    """Create everything a sandbox runs on, returns the Sandbox attributes describing it.
+
+    The CloudMap service, task definition, access log stream and (with ``shutdown_at``) shutdown schedule
+    do not depend on each other and are created concurrently, the ECS service starts as soon as its
+    CloudMap service and task definition exist. Leaving the executor waits for every step, so nothing
+    still in flight escapes the rollback.
+    """
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        cloudmap_future = executor.submit(create_cloudmap_service, cloudmap_service_name, rollback)
+        task_definition_future = executor.submit(resolve_task_definition)
+        log_stream_future = executor.submit(create_access_log_stream, service_uuid, rollback)
+        schedule_future = executor.submit(create_shutdown_schedule, service_uuid, shutdown_at, rollback) if shutdown_at else None
+
+        cloudmap_service_arn = cloudmap_future.result()
+        task_definition_arn = task_definition_future.result()
+        service_arn = create_ecs_service(
+            service_uuid, tags, task_definition_arn, cloudmap_service_arn, rollback, desired_count=desired_count
+        )
+
+        log_stream_future.result()
+        shutdown_schedule_arn = schedule_future.result() if schedule_future else None
+
+    return {
+        "task_definition_arn": task_definition_arn,
+        "cloudmap_service_arn": cloudmap_service_arn,
+        "cloudmap_service_name": cloudmap_service_name,
+        "service_arn": service_arn,
+        "shutdown_schedule_arn": shutdown_schedule_arn
+    }
+
+
+def create_pool_slot():
+    """Pre-create an unclaimed sandbox with its ECS service at desiredCount 0, returns the slot uuid."""
+    slot_uuid = str(uuid.uuid4())
+    rollback = Rollback()
+
+    try:
+        # CloudMap service names cannot change, so a slot registers under its own name instead of a domain
+        resources = create_sandbox_resources(
+            slot_uuid, f"pool-{slot_uuid}", sandbox_tags(slot_uuid), rollback, desired_count=0
+        )
+        store.put(Sandbox(
+            uuid=slot_uuid,
+            pool_slot=POOL_AVAILABLE,
+            task_status="STOPPED",
+            desired_tasks=0,
+            created_at=datetime.now().isoformat(),
+            updated_at=datetime.now().isoformat(),
+            **resources
+        ), condition="attribute_not_exists(#uuid)")
+    except Exception:
+        rollback.run()
+        raise
+
+    return slot_uuid
+
+
+def trim_pool_slot(slot_uuid):
+    """Take a surplus slot out of the pool and have deprovision-sandbox delete it, returns whether it did.
+
+    A slot claimed concurrently keeps serving its PR. A slot left DELETING because the invoke failed
+    is retried by the deprovision-sandbox garbage collection sweep.
+    """
+    try:
+        store.update(slot_uuid).set(task_status="DELETING", updated_at=datetime.now().isoformat()).remove(
+            "pool_slot"
+        ).commit(condition="#pool_slot = :available", available=POOL_AVAILABLE)
+    except store.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+    lambda_client.invoke(
+        FunctionName=deprovision_lambda_arn,
+        InvocationType='Event',
+        Payload=json.dumps({"service_uuid": slot_uuid})
     )
+    return True
 
-    # set service arn and desired_tasks to 1 in ddb
-    ddb.update_item(
-        TableName=environ.get("metadata_ddb_table"),
-        Key={
-            "uuid": {
-                "S": service_uuid
-            }
-        },
-        UpdateExpression="SET service_arn = :service_arn, desired_tasks = :desired_tasks",
-        ExpressionAttributeValues={
-            ":service_arn": {
-                "S": ecs_service["service"]["serviceArn"]
-            },
-            ":desired_tasks": {
-                "N": "1"
-            }
+
+def refill_warm_pool(context=None):
+    """Create or trim warm pool slots until warm_pool_size unclaimed ones exist.
+
+    Runs every minute under a lease, so a slow run and the next one never both count the pool and create
+    the same missing slots. Slots above warm_pool_size, left by a lagging PoolIndex or a smaller
+    warm_pool_size, are deleted.
+    """
+    owner = getattr(context, "aws_request_id", None) or str(uuid.uuid4())
+    if not store.acquire_lease("warm-pool-refill", owner, warm_pool_refill_lease_seconds):
+        print("Another warm pool refill is running")
+        return {
+            "statusCode": 409,
+            "body": json.dumps({
+                "message": "another warm pool refill is running"
+            })
         }
+
+    try:
+        slots = list(store.pool_slots())
+        available = len(slots)
+        missing = max(warm_pool_size - available, 0)
+        surplus = slots[warm_pool_size:]
+
+        failed = 0
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(missing, warm_pool_refill_workers)) as executor:
+                futures = [executor.submit(create_pool_slot) for _ in range(missing)]
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Error creating warm pool slot: {e!r}")
+                        failed += 1
+
+        trimmed = 0
+        for slot_uuid in surplus:
+            try:
+                trimmed += trim_pool_slot(slot_uuid)
+            except Exception as e:
+                print(f"Error trimming warm pool slot {slot_uuid}: {e!r}")
+    finally:
+        store.release_lease("warm-pool-refill", owner)
+
+    print(
+        f"Warm pool had {available} of {warm_pool_size} slots, created {missing - failed}, {failed} failed, "
+        f"trimmed {trimmed}"
+    )
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "available": available + missing - failed - trimmed,
+            "created": missing - failed,
+            "failed": failed,
+            "trimmed": trimmed
+        })
+    }
+
+
+def claim_pool_slot(claim):
+    """Atomically take an unclaimed warm pool slot and bind ``claim`` to it, None when the pool is empty."""
+    for slot_uuid in store.pool_slots(limit=POOL_CLAIM_CANDIDATES):
+        try:
+            response = store.update(slot_uuid).set(**claim).remove("pool_slot").commit(
+                condition="#pool_slot = :available",
+                return_values="ALL_NEW",
+                available=POOL_AVAILABLE
+            )
+        except store.client.exceptions.ConditionalCheckFailedException:
+            continue  # a concurrent provision claimed it first
+
+        return Sandbox.from_item(response["Attributes"])
+
+    return None
+
+
+def release_pool_slot(slot_uuid):
+    store.update(slot_uuid).set(
+        pool_slot=POOL_AVAILABLE,
+        desired_tasks=0,
+        task_status="STOPPED",
+        updated_at=datetime.now().isoformat()
+    ).remove(*CLAIMED_ATTRIBUTES).commit()
+
+
+def scale_up_service(service_arn, task_definition_arn, rollback):
+    ecs.update_service(
+        cluster=environ.get("ecs_cluster_arn"),
+        service=service_arn,
+        taskDefinition=task_definition_arn,
+        desiredCount=1
     )
+    rollback.add("scale up", lambda: ecs.update_service(
+        cluster=environ.get("ecs_cluster_arn"),
+        service=service_arn,
+        desiredCount=0
+    ))
+
+
+def tag_service(service_arn, tags):
+    try:
+        ecs.tag_resource(resourceArn=service_arn, tags=tags)
+    except Exception as e:
+        # tags only describe the sandbox, a failure must not fail the provision
+        print(f"Error tagging {service_arn}: {e!r}")
 
+
+def provision_from_pool(event, full_domain, claim_uuid):
+    """Bind a warm pool slot to the domain and scale it to 1, None when no slot could be claimed.
+
+    The domain is held under ``claim_uuid`` until a slot is claimed, then handed over to the slot.
+    """
     in_10_mins_datetime = datetime.now() + timedelta(minutes=10)
+    task_definition_arn = resolve_task_definition()
 
-    scheduler_schedule = scheduler.create_schedule(
-        Name=f"{company_prefix}-{service_uuid}",
-        GroupName=environ.get("scheduler_group_name"),
-        ActionAfterCompletion="NONE",
-        FlexibleTimeWindow={
-            "Mode": "OFF"
-        },
-        ScheduleExpression=f"at({in_10_mins_datetime.strftime('%Y-%m-%dT%H:%M:%S')})",
-        Target={
-            "Arn": environ.get("shutdown_lambda_arn", ""),
-            "RoleArn": environ.get("scheduler_role_arn", ""),
-            "Input": json.dumps({
-                "service_uuid": service_uuid
-            })
-        }
+    claim = {
+        "domain": full_domain,
+        "pr": event["pr"],
+        "repository": event["repository"],
+        "user": event["user"],
+        "created_by_user_id": event["created_by_user_id"],
+        "registry": "github",
+        "task_status": "STARTING",
+        "desired_tasks": 1,
+        "task_definition_arn": task_definition_arn,
+        "created_at": datetime.now().isoformat(),
+        "updated_at": datetime.now().isoformat(),
+        "last_activity_at": int(time.time()),
+        "next_shutdown_at": in_10_mins_datetime.strftime(SCHEDULE_TIME_FORMAT)
+    }
+    if idle_reaper_enabled:
+        claim["is_running"] = RUNNING
+
+    slot = claim_pool_slot(claim)
+    if not slot:
+        return None
+
+    print(f"Claimed warm pool slot {slot.uuid} for {full_domain}")
+    rollback = Rollback()
+    rollback.add("warm pool claim", lambda: release_pool_slot(slot.uuid))
+
+    try:
+        store.claim_domain(full_domain, slot.uuid, previous_owner=claim_uuid)
+        rollback.add("domain claim", lambda: store.release_domain(full_domain, slot.uuid))
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            scale_future = executor.submit(scale_up_service, slot.service_arn, task_definition_arn, rollback)
+            executor.submit(tag_service, slot.service_arn, sandbox_tags(slot.uuid, event))
+            schedule_future = None if idle_reaper_enabled else executor.submit(
+                create_shutdown_schedule, slot.uuid, in_10_mins_datetime, rollback
+            )
+
+            scale_future.result()
+            shutdown_schedule_arn = schedule_future.result() if schedule_future else None
+
+        if shutdown_schedule_arn:
+            store.update(slot.uuid).set(shutdown_schedule_arn=shutdown_schedule_arn).commit()
+    except Exception:
+        rollback.run()
+        raise
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": "success",
+            "service_uuid": slot.uuid,
+            "domain": full_domain
+        })
+    }
+
+
+def update_sandbox(service_uuid, sandbox, full_domain):
+    """Roll an existing sandbox onto the current task definition and wake it, instead of creating a new one."""
+    task_definition_arn = resolve_task_definition()
+
+    # a new deployment also pulls the image again when its tag was pushed to
+    ecs.update_service(
+        cluster=environ.get("ecs_cluster_arn"),
+        service=sandbox.service_arn,
+        taskDefinition=task_definition_arn,
+        desiredCount=1,
+        forceNewDeployment=True
     )
 
-    ddb.update_item(
-        TableName=environ.get("metadata_ddb_table"),
-        Key={
-            "uuid": {
-                "S": service_uuid
-            }
-        },
-        UpdateExpression="SET shutdown_schedule_arn = :shutdown_schedule_arn, next_shutdown_at = :next_shutdown_at",
-        ExpressionAttributeValues={
-            ":shutdown_schedule_arn": {
-                "S": scheduler_schedule["ScheduleArn"]
-            },
-            ":next_shutdown_at": {
-                "S": in_10_mins_datetime.strftime("%Y-%m-%dT%H:%M:%S")
-            }
-        }
+    in_10_mins_datetime = datetime.now() + timedelta(minutes=10)
+    update = store.update(service_uuid).set(
+        task_definition_arn=task_definition_arn,
+        desired_tasks=1,
+        task_status="STARTING",
+        updated_at=datetime.now().isoformat(),
+        last_activity_at=int(time.time()),
+        next_shutdown_at=in_10_mins_datetime.strftime(SCHEDULE_TIME_FORMAT)
     )
 
+    if idle_reaper_enabled:
+        update.set(is_running=RUNNING)
+    else:
+        new_schedule_arn = arm_shutdown_schedule(
+            scheduler, service_uuid, in_10_mins_datetime, environ.get("shutdown_lambda_arn", ""),
+            exists=bool(sandbox.shutdown_schedule_arn)
+        )
+        if new_schedule_arn:
+            update.set(shutdown_schedule_arn=new_schedule_arn)
+
+    update.commit(condition="attribute_exists(#uuid)")
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": "updated",
+            "service_uuid": service_uuid,
+            "domain": full_domain
+        })
+    }
+
+
+def sandbox_domain(request):
+    return f"{request['pr']}-{request['repository']}-{request['user']}.gh.{environ.get('domain')}"
+
+
+def claim_domain(full_domain, service_uuid):
+    """Take the domain for service_uuid before anything is created, returns the uuid already owning it.
+
+    DomainIndex is eventually consistent and the metadata row is only written once every resource exists,
+    so two provisions of one PR could both miss a lookup. The conditional write of the domain claim lets
+    exactly one of them through, None means service_uuid now holds the domain. A claim whose owner never
+    wrote its row (the provision failed without releasing it) is taken over once it expires.
+    """
+    for _ in range(3):
+        claim = store.domain_claim(full_domain)
+        previous_owner = None
+        if claim:
+            owner_uuid, expires_at = claim
+            if (expires_at and expires_at > time.time()) or store.get(owner_uuid, ["uuid"], consistent=True):
+                return owner_uuid
+            previous_owner = owner_uuid
+        else:
+            # sandboxes provisioned before domain claims existed are only found through DomainIndex
+            legacy_uuid = store.find_uuid_by_domain(full_domain)
+            if legacy_uuid:
+                try:
+                    store.claim_domain(full_domain, legacy_uuid)
+                except store.client.exceptions.ConditionalCheckFailedException:
+                    continue
+                return legacy_uuid
+
+        try:
+            store.claim_domain(
+                full_domain, service_uuid, int(time.time()) + domain_claim_seconds, previous_owner=previous_owner
+            )
+            return None
+        except store.client.exceptions.ConditionalCheckFailedException:
+            continue  # a concurrent provision changed the claim, look again
+
+    raise RuntimeError(f"Could not claim {full_domain}, it keeps changing hands")
+
+
+def conflict(message):
+    print(message)
+    return {
+        "statusCode": 409,
+        "body": json.dumps({
+            "message": message
+        })
+    }
+
+
+def provision_sandbox(event):
+    """Provision the sandbox of one PR.
+
+    An existing sandbox for the domain is updated in place, otherwise a warm pool slot is claimed when
+    one is available. Only when the pool is empty are the resources created from scratch, with the metadata
+    row written once after everything exists. Created resources are only tracked to roll them back if a
+    later step fails.
+    """
+    full_domain = sandbox_domain(event)
+    service_uuid = str(uuid.uuid4())
+
+    # provisioning is idempotent on the domain, a PR that already has a sandbox gets it updated in place
+    owner_uuid = claim_domain(full_domain, service_uuid)
+    if owner_uuid:
+        sandbox = store.get(owner_uuid, ["service_arn", "shutdown_schedule_arn", "task_status"], consistent=True)
+        if sandbox and sandbox.task_status == "DELETING":
+            return conflict(f"The sandbox of {full_domain} is being deprovisioned, retry once it is gone")
+        if sandbox and sandbox.service_arn:
+            print(f"Sandbox {owner_uuid} already exists for {full_domain}, updating it")
+            return update_sandbox(owner_uuid, sandbox, full_domain)
+        return conflict(f"The sandbox of {full_domain} is already being provisioned")
+
+    print(f"{company_prefix}-{service_uuid}")
+
+    in_10_mins_datetime = datetime.now() + timedelta(minutes=10)
+    rollback = Rollback()
+    rollback.add("domain claim", lambda: store.release_domain(full_domain, service_uuid))
+
+    try:
+        if warm_pool_size > 0:
+            response = provision_from_pool(event, full_domain, service_uuid)
+            if response:
+                return response
+            print("Warm pool is empty, creating the sandbox from scratch")
+
+        resources = create_sandbox_resources(
+            service_uuid, full_domain, sandbox_tags(service_uuid, event), rollback,
+            shutdown_at=None if idle_reaper_enabled else in_10_mins_datetime
+        )
+
+        store.put(Sandbox(
+            uuid=service_uuid,
+            created_by_user_id=event["created_by_user_id"],
+            pr=event["pr"],
+            repository=event["repository"],
+            user=event["user"],
+            task_status="STARTING",
+            domain=full_domain,
+            registry="github",
+            created_at=datetime.now().isoformat(),
+            updated_at=datetime.now().isoformat(),
+            last_activity_at=int(time.time()),
+            desired_tasks=1,
+            next_shutdown_at=in_10_mins_datetime.strftime(SCHEDULE_TIME_FORMAT),
+            # the shutdown-sandbox reaper sweep finds it through RunningIndex, no schedule of its own needed
+            is_running=RUNNING if idle_reaper_enabled else None,
+            **resources
+        ), condition="attribute_not_exists(#uuid)")
+    except Exception:
+        rollback.run()
+        raise
+
     return {
         "statusCode": 200,
         "body": json.dumps({
@@ -291,3 +677,89 @@ def lambda_handler(event, context):
             "domain": full_domain
         })
     }
+
+
+def provision_batch(requests, context=None):
+    """Provision many PRs with at most provision_batch_concurrency in flight, one result per request.
+
+    Requests for the same domain are provisioned once and share the result, a failed request does not
+    stop the others. Requests the invocation has no time left for are not started and come back as
+    deferred, for the caller to send again.
+    """
+    results = [None] * len(requests)
+    by_domain = {}
+    for index, request in enumerate(requests):
+        missing = [k for k in REQUIRED_PARAMETERS if not isinstance(request, dict) or k not in request]
+        if missing:
+            results[index] = {"statusCode": 400, "error": f"missing required parameters: {', '.join(missing)}"}
+        else:
+            by_domain.setdefault(sandbox_domain(request), []).append(index)
+
+    def provision_one(indexes):
+        # checked when a worker picks the request up, a provision cut off by the timeout never rolls back
+        if context is not None and context.get_remaining_time_in_millis() < provision_batch_time_margin_ms:
+            for index in indexes:
+                results[index] = {"statusCode": 503, "deferred": True}
+            return
+        try:
+            with metrics.timer("BatchItem"):
+                response = provision_sandbox(requests[indexes[0]])
+            result = {"statusCode": response["statusCode"], **json.loads(response["body"])}
+        except Exception as e:
+            print(f"Error provisioning {requests[indexes[0]]}: {e!r}")
+            result = {"statusCode": 500, "error": repr(e)}
+        for index in indexes:
+            results[index] = result
+
+    if by_domain:
+        with ThreadPoolExecutor(max_workers=min(provision_batch_concurrency, len(by_domain))) as executor:
+            list(executor.map(provision_one, by_domain.values()))
+
+    deferred = sum(bool(result.get("deferred")) for result in results)
+    failed = sum(result["statusCode"] != 200 for result in results) - deferred
+    provisioned = len(requests) - failed - deferred
+    print(
+        f"Provisioned {provisioned} of {len(requests)} batched sandboxes, {failed} failed, "
+        f"{deferred} deferred for lack of time"
+    )
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "provisioned": provisioned,
+            "failed": failed,
+            "deferred": deferred,
+            "results": results
+        })
+    }
+
+
+@metrics.instrument_handler
+def lambda_handler(event, context):
+    """Provision one PR, a batch given as ``{"sandboxes": [...]}``, or refill the warm pool (``{"refill_pool": true}``)."""
+    if event.get("refill_pool"):
+        return refill_warm_pool(context)
+
+    # todo: auth
+
+    if "sandboxes" in event:
+        requests = event["sandboxes"]
+        if not isinstance(requests, list) or not requests or len(requests) > provision_batch_max_items:
+            return {
+                "statusCode": 400,
+                "body": json.dumps({
+                    "message": f"sandboxes must be a list of 1 to {provision_batch_max_items} requests"
+                })
+            }
+        return provision_batch(requests, context)
+
+    if not all(k in event for k in REQUIRED_PARAMETERS):
+        print(event.get(k) for k in REQUIRED_PARAMETERS)
+        return {
+            "statusCode": 400,
+            "body": json.dumps({
+                "message": "missing required parameters"
+            })
+        }
+
+    return provision_sandbox(event)
@@ -1,106 +1,646 @@
+import base64
+import gzip
 import json
+import random
 import time
-import boto3
-import requests
+import urllib3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
-from botocore.config import Config
+from threading import Lock
+from sandbox_shared.clients import lazy_client
+from sandbox_shared.metrics import metrics
+from sandbox_shared.store import SandboxStore
+
+try:
+    import brotli
+except ImportError:  # br is only offered when the dependency layer ships it
+    brotli = None
 
 # AWS Client Configuration
-AWS_CONFIG = Config(connect_timeout=2, read_timeout=2, retries={'max_attempts': 5})
+AWS_CONFIG = {"connect_timeout": 2, "read_timeout": 2, "retries": {'max_attempts': 5}}
 
 # Initialize AWS Clients
-cloudmap_client = boto3.client('servicediscovery', config=AWS_CONFIG)
-cloudwatch_client = boto3.client('logs')
-lambda_client = boto3.client('lambda')
-dynamodb_client = boto3.client('dynamodb')
+cloudmap_client = lazy_client('servicediscovery', config=AWS_CONFIG)
+cloudwatch_client = lazy_client('logs')
+lambda_client = lazy_client('lambda')
+dynamodb_client = lazy_client('dynamodb')
 
 # Environment Variables
 env_full_domain = environ.get("full_domain")
 env_startup_task_lambda_arn = environ.get("startup_task_lambda_arn")
 cloudmap_namespace = environ.get("cloudmap_namespace")
 metadata_ddb_table_name = environ.get("metadata_ddb_table_name", "")
+metadata_store = SandboxStore(dynamodb_client, metadata_ddb_table_name)
 ecs_access_log_group_name = environ.get("ecs_access_log_group_name")
+backend_cache_ttl_seconds = float(environ.get("backend_cache_ttl_seconds", "30"))
+backend_cache_negative_ttl_seconds = float(environ.get("backend_cache_negative_ttl_seconds", "2"))
+backend_cache_max_entries = int(environ.get("backend_cache_max_entries", "512"))
+backend_ejection_seconds = float(environ.get("backend_ejection_seconds", "30"))
+domain_cache_ttl_seconds = float(environ.get("domain_cache_ttl_seconds", "3600"))
+domain_cache_negative_ttl_seconds = float(environ.get("domain_cache_negative_ttl_seconds", "5"))
+domain_cache_max_entries = int(environ.get("domain_cache_max_entries", "1024"))
+access_log_activity_interval_seconds = float(environ.get("access_log_activity_interval_seconds", "30"))
+access_log_max_batch_events = int(environ.get("access_log_max_batch_events", "100"))
+activity_write_interval_seconds = int(environ.get("activity_write_interval_seconds", "60"))
+upstream_pool_maxsize = int(environ.get("upstream_pool_maxsize", "10"))
+upstream_connect_timeout_seconds = float(environ.get("upstream_connect_timeout_seconds", "2"))
+upstream_read_timeout_seconds = float(environ.get("upstream_read_timeout_seconds", "10"))
+
+wake_lease_seconds = int(environ.get("wake_lease_seconds", "60"))
+wake_wait_budget_seconds = float(environ.get("wake_wait_budget_seconds", "12"))
+wake_wait_initial_delay_seconds = float(environ.get("wake_wait_initial_delay_seconds", "0.25"))
+wake_wait_max_delay_seconds = float(environ.get("wake_wait_max_delay_seconds", "2"))
+wake_wait_retry_after_seconds = int(environ.get("wake_wait_retry_after_seconds", "5"))
+background_workers = int(environ.get("background_workers", "4"))
+background_wait_timeout_seconds = float(environ.get("background_wait_timeout_seconds", "2"))
+response_compression_min_bytes = int(environ.get("response_compression_min_bytes", "1024"))
+response_cache_enabled = environ.get("response_cache_enabled", "false").lower() == "true"
+response_cache_max_bytes_per_sandbox = int(environ.get("response_cache_max_bytes_per_sandbox", str(2 * 1024 * 1024)))
+response_cache_max_sandboxes = int(environ.get("response_cache_max_sandboxes", "16"))
+response_cache_max_entry_bytes = int(environ.get("response_cache_max_entry_bytes", str(512 * 1024)))
+# Lambda caps synchronous response payloads at 6MB, leave headroom for headers and the JSON envelope
+max_response_payload_bytes = int(environ.get("max_response_payload_bytes", str(6 * 1024 * 1024 - 64 * 1024)))
+
+SUPPORTED_HTTP_METHODS = {"GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"}
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+    "transfer-encoding", "upgrade", "content-length"
+}
+TEXT_CONTENT_TYPES = {"application/json", "application/javascript", "application/xml", "image/svg+xml"}
+
+
+class TTLCache:
+    """Bounded LRU cache with per-entry expiry, kept for the life of the warm container."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return (hit, value). A hit may carry a value of None for negatively cached keys."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return False, None
+
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl_seconds=None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class AccessLogBuffer:
+    """Buffers access log events per log stream and writes them with one put_log_events call per stream.
+
+    Activity is throttled per stream: at most one event is recorded every ``activity_interval_seconds``,
+    idle detection uses ``last_activity_at`` on the metadata row instead. Buffered streams are flushed once they reach
+    ``max_batch_events`` and always by ``flush()`` before the invocation returns.
+    """
+
+    def __init__(self, log_group_name, activity_interval_seconds, max_batch_events):
+        self.log_group_name = log_group_name
+        self.activity_interval_seconds = activity_interval_seconds
+        self.max_batch_events = max_batch_events
+        self._events = {}
+        self._last_recorded = {}
+        self._lock = Lock()
+
+    def record(self, stream_name, message, timestamp_ms=None):
+        """Buffer an event for the stream, returns False when it was throttled."""
+        now = time.monotonic()
+        with self._lock:
+            last_recorded = self._last_recorded.get(stream_name)
+            if last_recorded is not None and now - last_recorded < self.activity_interval_seconds:
+                return False
+
+            self._last_recorded[stream_name] = now
+            events = self._events.setdefault(stream_name, [])
+            events.append({
+                "timestamp": timestamp_ms if timestamp_ms is not None else int(time.time() * 1000),
+                "message": message
+            })
+            batch_full = len(events) >= self.max_batch_events
+
+        if batch_full:
+            self.flush(stream_name)
+        return True
+
+    def flush(self, stream_name=None):
+        with self._lock:
+            if stream_name is None:
+                pending, self._events = self._events, {}
+            else:
+                pending = {stream_name: self._events.pop(stream_name, [])}
+
+        for stream, events in pending.items():
+            if not events:
+                continue
+
+            try:
+                cloudwatch_client.put_log_events(
+                    logGroupName=self.log_group_name,
+                    logStreamName=stream,
+                    logEvents=sorted(events, key=lambda e: e["timestamp"])
+                )
+            except Exception as e:
+                # access logs are best effort, allow the stream to record again on the next request
+                print(f"Error writing access logs for {stream}: {e}")
+                with self._lock:
+                    self._last_recorded.pop(stream, None)
+
+
+class UpstreamPools:
+    """Keep-alive urllib3 connection pool per backend endpoint, reused across warm invocations.
+
+    urllib3 is already loaded by botocore, so this costs nothing extra at import and, unlike a requests
+    session, never stores cookies between users. Pools are closed once their endpoint drops out of the
+    service's discovered instances.
+    """
+
+    def __init__(self, pool_maxsize, connect_timeout, read_timeout):
+        self.pool_maxsize = pool_maxsize
+        self.timeout = urllib3.Timeout(connect=connect_timeout, read=read_timeout)
+        self._pools = {}
+        self._service_endpoints = {}
+        self._lock = Lock()
+
+    def get(self, endpoint):
+        with self._lock:
+            pool = self._pools.get(endpoint)
+            if pool is None:
+                host, _, port = endpoint.partition(":")
+                pool = urllib3.HTTPConnectionPool(
+                    host,
+                    port=int(port) if port else 80,
+                    maxsize=self.pool_maxsize,
+                    block=False,
+                    timeout=self.timeout,
+                    retries=False
+                )
+                self._pools[endpoint] = pool
+            return pool
+
+    def retain(self, backend_key, endpoints):
+        """Record the service's current endpoints and close pools for the ones that went away."""
+        with self._lock:
+            previous = self._service_endpoints.get(backend_key, set())
+            self._service_endpoints[backend_key] = set(endpoints)
+            still_used = set().union(*self._service_endpoints.values())
+            stale = [self._pools.pop(e) for e in previous - still_used if e in self._pools]
+
+        for pool in stale:
+            pool.close()
+
+    def evict(self, endpoint):
+        with self._lock:
+            pool = self._pools.pop(endpoint, None)
+        if pool:
+            pool.close()
+
+
+class BackendBalancer:
+    """Round-robin across a service's instances with passive ejection of failing backends.
+
+    A Lambda container serves one request at a time, so outstanding request counts would always be
+    zero here; round-robin from a random starting point spreads load across containers instead.
+    Endpoints that fail to connect or time out are skipped for ``ejection_seconds``.
+    """
+
+    def __init__(self, ejection_seconds):
+        self.ejection_seconds = ejection_seconds
+        self._cursors = {}
+        self._ejected_until = {}
+        self._lock = Lock()
+
+    def choose(self, backend_key, endpoints):
+        now = time.monotonic()
+        with self._lock:
+            available = [e for e in endpoints if self._ejected_until.get(e, 0) <= now]
+            if not available:
+                # every instance is ejected, fail open on the one that has been out the longest
+                available = [min(endpoints, key=lambda e: self._ejected_until.get(e, 0))]
+
+            cursor = self._cursors.get(backend_key)
+            if cursor is None:
+                cursor = random.randrange(len(endpoints))
+            self._cursors[backend_key] = cursor + 1
+            return available[cursor % len(available)]
+
+    def eject(self, endpoint):
+        now = time.monotonic()
+        with self._lock:
+            for expired in [e for e, until in self._ejected_until.items() if until <= now]:
+                del self._ejected_until[expired]
+            self._ejected_until[endpoint] = now + self.ejection_seconds
+
+    def all_ejected(self, endpoints):
+        now = time.monotonic()
+        with self._lock:
+            return all(self._ejected_until.get(e, 0) > now for e in endpoints)
+
+
+class UpstreamResponse:
+    """An upstream response read into memory, entries of the response cache are kept in this form."""
+
+    def __init__(self, status, headers, body, content_type, upstream_encoding):
+        self.status = status
+        self.headers = headers  # lowercased name -> list of values, hop-by-hop headers removed
+        self.body = body
+        self.content_type = content_type
+        self.upstream_encoding = upstream_encoding
+        # set once the response is stored in the response cache
+        self.etag = None
+        self.stored_at = 0
+        self.fresh_until = 0
+        self.accept_encoding = None  # the only Accept-Encoding the entry may answer, None for any
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(name) + sum(len(v) for v in values) for name, values in self.headers.items())
+
+    def is_fresh(self):
+        return time.monotonic() < self.fresh_until
+
+
+class ResponseCache:
+    """LRU cache of GET responses per sandbox, each sandbox limited to ``max_bytes_per_sandbox``.
+
+    Entries belong to the set of backend instances they were fetched from. A restart or re-provision
+    registers new tasks, so the first request that sees a different instance set drops the sandbox's
+    entries. Stale entries with an ETag are revalidated with If-None-Match rather than refetched.
+    """
 
+    def __init__(self, max_bytes_per_sandbox, max_sandboxes, max_entry_bytes):
+        self.max_bytes_per_sandbox = max_bytes_per_sandbox
+        self.max_sandboxes = max_sandboxes
+        self.max_entry_bytes = max_entry_bytes
+        # backend key -> {"generation": backend ips, "entries": OrderedDict, "bytes": int}
+        self._sandboxes = OrderedDict()
+        self._lock = Lock()
 
-def log_execution_time(start_time, operation):
-    elapsed_time_ms = round((time.time() - start_time) * 1000)
-    print(f"{operation} completed in {elapsed_time_ms}ms")
+    def _sandbox(self, backend_key, generation):
+        sandbox = self._sandboxes.get(backend_key)
+        if sandbox is None or sandbox["generation"] != generation:
+            sandbox = {"generation": generation, "entries": OrderedDict(), "bytes": 0}
+            self._sandboxes[backend_key] = sandbox
+        self._sandboxes.move_to_end(backend_key)
+        while len(self._sandboxes) > self.max_sandboxes:
+            self._sandboxes.popitem(last=False)
+        return sandbox
 
+    def get(self, backend_key, generation, cache_key, accept_encoding):
+        with self._lock:
+            entries = self._sandbox(backend_key, generation)["entries"]
+            entry = entries.get(cache_key)
+            if entry is None or entry.accept_encoding not in (None, accept_encoding or ""):
+                return None
+            entries.move_to_end(cache_key)
+            return entry
 
-def fetch_service_instance(service_name, registry, full_domain, host):
-    full_service_name = f"{service_name}.{registry}.{full_domain}"
-    print(f"Fetching CloudMap instance for {cloudmap_namespace} name {full_service_name}")
+    def store(self, backend_key, generation, cache_key, entry):
+        size = entry.size
+        if size > min(self.max_entry_bytes, self.max_bytes_per_sandbox):
+            return
+
+        with self._lock:
+            sandbox = self._sandbox(backend_key, generation)
+            entries = sandbox["entries"]
+            previous = entries.pop(cache_key, None)
+            if previous is not None:
+                sandbox["bytes"] -= previous.size
+
+            entries[cache_key] = entry
+            sandbox["bytes"] += size
+            while sandbox["bytes"] > self.max_bytes_per_sandbox:
+                _, evicted = entries.popitem(last=False)
+                sandbox["bytes"] -= evicted.size
+
+    def refresh(self, entry, not_modified_headers):
+        """Renew a revalidated entry with the caching headers of the 304 response."""
+        with self._lock:
+            for name in ("cache-control", "etag", "expires"):
+                if name in not_modified_headers:
+                    entry.headers[name] = not_modified_headers[name]
+            entry.stored_at = time.monotonic()
+            entry.fresh_until = entry.stored_at + freshness_lifetime(entry.headers)
+
+    def invalidate(self, backend_key):
+        with self._lock:
+            self._sandboxes.pop(backend_key, None)
+
+
+# Warm container cache: CloudMap service name -> tuple of AWS_INSTANCE_IPV4 (None when no instances are registered)
+backend_ip_cache = TTLCache(backend_cache_max_entries, backend_cache_ttl_seconds)
+# Warm container cache: host -> Sandbox (uuid and CloudMap service name), fixed for the life of a sandbox
+domain_sandbox_cache = TTLCache(domain_cache_max_entries, domain_cache_ttl_seconds)
+# Warm container throttle: service uuid -> True while its last_activity_at write is recent enough
+activity_write_cache = TTLCache(domain_cache_max_entries, activity_write_interval_seconds)
+access_log_buffer = AccessLogBuffer(
+    ecs_access_log_group_name, access_log_activity_interval_seconds, access_log_max_batch_events
+)
+upstream_pools = UpstreamPools(
+    upstream_pool_maxsize, upstream_connect_timeout_seconds, upstream_read_timeout_seconds
+)
+backend_balancer = BackendBalancer(backend_ejection_seconds)
+response_cache = ResponseCache(
+    response_cache_max_bytes_per_sandbox, response_cache_max_sandboxes, response_cache_max_entry_bytes
+) if response_cache_enabled else None
+# Bookkeeping (uuid lookups, access logs) runs here so it overlaps with forwarding instead of blocking it
+background_executor = ThreadPoolExecutor(max_workers=background_workers, thread_name_prefix="proxy-background")
+
+
+class RequestContext:
+    """Routing data for a single proxied request, each lookup is resolved at most once."""
+
+    _unresolved = object()
+
+    def __init__(self, host, service_name, registry, full_domain):
+        self.host = host
+        self.service_name = service_name
+        self.registry = registry
+        self.full_domain = full_domain
+        self.full_service_name = f"{service_name}.{registry}.{full_domain}"
+        self._sandbox = self._unresolved
+        self._sandbox_future = None
+        self._metadata = self._unresolved
+        self.sandbox_asleep = False
+        self.backend_ips = ()
+
+    def prefetch(self):
+        """Start resolving the sandbox of the host in the background when it is not already cached."""
+        cache_hit, cached_sandbox = domain_sandbox_cache.get(self.host)
+        if cache_hit:
+            self._sandbox = cached_sandbox
+        elif self._sandbox_future is None:
+            self._sandbox_future = background_executor.submit(get_sandbox_from_domain, self.host)
+
+    @property
+    def sandbox(self):
+        if self._sandbox is self._unresolved:
+            if self._sandbox_future is not None:
+                self._sandbox = self._sandbox_future.result()
+            else:
+                self._sandbox = get_sandbox_from_domain(self.host)
+        return self._sandbox
+
+    @property
+    def service_uuid(self):
+        return self.sandbox.uuid if self.sandbox else None
+
+    @property
+    def cloudmap_service_name(self):
+        # sandboxes claimed from the warm pool keep the CloudMap service they were created with
+        return (self.sandbox and self.sandbox.cloudmap_service_name) or self.full_service_name
+
+    @property
+    def known_cloudmap_service_name(self):
+        """cloudmap_service_name when the sandbox is already resolved, None instead of waiting for the lookup."""
+        if self._sandbox is self._unresolved and (self._sandbox_future is None or not self._sandbox_future.done()):
+            return None
+        return self.cloudmap_service_name
+
+    @property
+    def metadata(self):
+        if self._metadata is self._unresolved:
+            self._metadata = get_service_metadata(self.service_uuid) if self.service_uuid else None
+        return self._metadata
+
+    @property
+    def sandbox_deleted(self):
+        """Whether the sandbox the host resolved to is gone or being deprovisioned."""
+        return self.service_uuid is not None and (self.metadata is None or self.metadata.task_status == "DELETING")
+
+    def refresh_sandbox(self):
+        """Drop the cached sandbox of the host and look it up again, returns whether another sandbox serves it now."""
+        previous_uuid = self.service_uuid
+        domain_sandbox_cache.invalidate(self.host)
+        self._sandbox, self._sandbox_future, self._metadata = self._unresolved, None, self._unresolved
+        return self.service_uuid not in (None, previous_uuid)
+
+
+def fetch_service_instance(ctx):
+    cache_hit, cached_ips = backend_ip_cache.get(ctx.full_service_name)
+    if not cache_hit:
+        try:
+            cached_ips = discover_service_instances(ctx)
+        except Exception as e:
+            print(f"Error fetching service instance: {e}")
+            return {"statusCode": 500, "body": "Internal Server Error"}
+
+    if not cached_ips and ctx.sandbox_deleted and ctx.refresh_sandbox():
+        # the cached sandbox was deprovisioned and the PR provisioned again, possibly from the warm pool
+        try:
+            cached_ips = discover_service_instances(ctx)
+        except Exception as e:
+            print(f"Error fetching service instance: {e}")
+            return {"statusCode": 500, "body": "Internal Server Error"}
+
+    if not cached_ips:
+        return handle_no_active_instances(ctx)
+
+    ctx.backend_ips = cached_ips
+    return backend_balancer.choose(ctx.full_service_name, cached_ips)
+
+
+def discover_instance_ips(service_name):
+    print(f"Fetching CloudMap instances for {cloudmap_namespace} name {service_name}")
 
-    start_time = time.time()
     try:
-        response = cloudmap_client.discover_instances(NamespaceName=cloudmap_namespace, ServiceName=full_service_name)
-        log_execution_time(start_time, "CloudMap instance discovery")
+        response = cloudmap_client.discover_instances(
+            NamespaceName=cloudmap_namespace,
+            ServiceName=service_name,
+            # leave out instances ECS has marked unhealthy (e.g. draining) while any healthy ones remain
+            HealthStatus="HEALTHY_OR_ELSE_ALL"
+        )
+    except cloudmap_client.exceptions.ServiceNotFound:
+        return ()
 
-        instances = response.get('Instances', [])
-        if not instances:
-            return handle_no_active_instances(service_name, registry, full_domain, host)
+    return tuple(sorted(
+        ip for ip in (i['Attributes'].get('AWS_INSTANCE_IPV4') for i in response.get('Instances', [])) if ip
+    ))
 
-        return instances[0]['Attributes'].get('AWS_INSTANCE_IPV4')
-    except Exception as e:
-        print(f"Error fetching service instance: {e}")
-        return {"statusCode": 500, "body": "Internal Server Error"}
 
+def discover_service_instances(ctx):
+    """Ask CloudMap for every registered sandbox backend and cache them, returns None when nothing is registered.
 
-def handle_no_active_instances(service_name, registry, full_domain, host):
-    service_uuid = get_service_uuid_from_domain(host)
-    print(f"No active instances found for {service_name}.{registry}.{full_domain}. Service UUID: {service_uuid}")
+    Most sandboxes are registered under the host name, so discovery starts with it while the prefetched
+    DomainIndex lookup is still in flight. Only a miss waits for the lookup, the sandbox may be a warm pool
+    slot registered under a name of its own.
+    """
+    service_name = ctx.known_cloudmap_service_name or ctx.full_service_name
+    instance_ips = discover_instance_ips(service_name)
+    if not instance_ips and service_name == ctx.full_service_name and ctx.cloudmap_service_name != service_name:
+        instance_ips = discover_instance_ips(ctx.cloudmap_service_name)
 
-    start_time = time.time()
-    dynamo_response = dynamodb_client.query(
-        TableName=metadata_ddb_table_name,
-        KeyConditionExpression="#d = :d",
-        ExpressionAttributeNames={"#d": "uuid"},
-        ExpressionAttributeValues={":d": {"S": service_uuid}}
-    )
-    log_execution_time(start_time, "DynamoDB query for metadata")
+    upstream_pools.retain(ctx.full_service_name, instance_ips)
+
+    if not instance_ips:
+        backend_ip_cache.set(ctx.full_service_name, None, backend_cache_negative_ttl_seconds)
+        return None
+
+    backend_ip_cache.set(ctx.full_service_name, instance_ips)
+    return instance_ips
+
+
+def wants_wake_wait(event):
+    """API clients opt in to holding the request while the sandbox wakes, browsers keep the loading page.
+
+    Selected with the ``sandbox_wait`` query flag, or by an Accept header naming a concrete media type
+    other than HTML. Requests a browser makes itself (scripts, images, fetch) carry Sec-Fetch headers and
+    never wait implicitly, one page load would otherwise hold dozens of invocations.
+    """
+    query = event.get('queryStringParameters') or {}
+    if "sandbox_wait" in query:
+        return query["sandbox_wait"].lower() not in ("0", "false", "no")
+
+    if get_request_header(event, "Sec-Fetch-Mode") or get_request_header(event, "Sec-Fetch-Dest"):
+        return False
+
+    accept = (get_request_header(event, "Accept") or "").lower()
+    media_types = [media_type.split(";")[0].strip() for media_type in accept.split(",")]
+    concrete = [media_type for media_type in media_types if media_type and not media_type.endswith("/*")]
+    return bool(concrete) and "text/html" not in accept
+
+
+def wait_for_service_instance(ctx, context):
+    """Poll CloudMap with exponential backoff until the woken sandbox registers or the wait budget runs out."""
+    budget_seconds = wake_wait_budget_seconds
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        # keep enough of the invocation left to forward the request once the instance appears
+        remaining = context.get_remaining_time_in_millis() / 1000 - upstream_read_timeout_seconds
+        budget_seconds = min(budget_seconds, max(remaining, 0))
+
+    deadline = time.monotonic() + budget_seconds
+    delay = wake_wait_initial_delay_seconds
+    start_time = time.perf_counter()
+
+    while True:
+        sleep_for = min(delay, deadline - time.monotonic())
+        if sleep_for <= 0:
+            break
+        time.sleep(sleep_for)
+
+        try:
+            instance_ips = discover_service_instances(ctx)
+        except Exception as e:
+            print(f"Error polling for service instance: {e}")
+            instance_ips = None
+
+        if instance_ips:
+            metrics.record("WakeWait", (time.perf_counter() - start_time) * 1000)
+            ctx.backend_ips = instance_ips
+            return backend_balancer.choose(ctx.full_service_name, instance_ips)
+
+        delay = min(delay * 2, wake_wait_max_delay_seconds)
+
+    metrics.record("WakeWait", (time.perf_counter() - start_time) * 1000, "timeout")
+    return {
+        "statusCode": 503,
+        "headers": {"Retry-After": str(wake_wait_retry_after_seconds), "Content-Type": "application/json"},
+        "body": json.dumps({'error': "Sandbox is starting, retry shortly"})
+    }
+
+
+def handle_no_active_instances(ctx):
+    print(f"No active instances found for {ctx.full_service_name}. Service UUID: {ctx.service_uuid}")
 
-    if dynamo_response.get("Items"):
-        item = dynamo_response["Items"][0]
-        desired_tasks = item.get("desired_tasks", {}).get("N")
-        task_status = item.get("task_status", {}).get("S")
+    sandbox = ctx.metadata
+    if sandbox and sandbox.task_status != "DELETING":
+        ctx.sandbox_asleep = True
 
-        if desired_tasks == "0" or task_status == "STOPPED":
-            invoke_lambda_for_service_startup(service_uuid)
+        if (sandbox.desired_tasks == 0 or sandbox.task_status == "STOPPED") and acquire_wake_lease(ctx.service_uuid, sandbox):
+            if response_cache is not None:
+                response_cache.invalidate(ctx.full_service_name)
+            try:
+                invoke_lambda_for_service_startup(ctx.service_uuid)
+            except Exception:
+                # let the next request retry the wake instead of waiting for the lease to expire
+                release_wake_lease(ctx.service_uuid)
+                raise
 
     return {
         "statusCode": 302,
-        "headers": {"Location": f"https://sb.{full_domain}/starting/{registry}/{service_name}"}
+        "headers": {"Location": f"https://sb.{ctx.full_domain}/starting/{ctx.registry}/{ctx.service_name}"}
     }
 
 
+def acquire_wake_lease(service_uuid, sandbox):
+    """Conditionally claim the wake lease so a burst of requests to a stopped sandbox triggers one restart."""
+    now = int(time.time())
+    if sandbox.wake_lease_until and sandbox.wake_lease_until > now:
+        print(f"Sandbox {service_uuid} is already starting, lease held until {sandbox.wake_lease_until}")
+        return False
+
+    try:
+        metadata_store.update(service_uuid).set(wake_lease_until=now + wake_lease_seconds).commit(
+            condition="attribute_exists(#uuid) AND (attribute_not_exists(#wake_lease_until) OR #wake_lease_until <= :now)",
+            now=now
+        )
+    except metadata_store.client.exceptions.ConditionalCheckFailedException:
+        print(f"Sandbox {service_uuid} is already starting, another request holds the wake lease")
+        return False
+
+    return True
+
+
+def release_wake_lease(service_uuid):
+    metadata_store.update(service_uuid).remove("wake_lease_until").commit()
+
+
 def invoke_lambda_for_service_startup(service_uuid):
     print(f"Invoking startup Lambda for service UUID: {service_uuid}")
 
-    start_time = time.time()
     lambda_client.invoke(
         FunctionName=env_startup_task_lambda_arn,
         InvocationType='Event',
         Payload=json.dumps({"service_uuid": service_uuid})
     )
-    log_execution_time(start_time, "Lambda invocation for startup")
 
 
-def get_service_uuid_from_domain(domain):
-    start_time = time.time()
-    response = dynamodb_client.query(
-        TableName=metadata_ddb_table_name,
-        IndexName="DomainIndex",
-        KeyConditionExpression="#d = :d",
-        ExpressionAttributeNames={"#d": "domain"},
-        ExpressionAttributeValues={":d": {"S": domain}}
-    )
-    log_execution_time(start_time, "DynamoDB query for service UUID")
+def get_sandbox_from_domain(domain):
+    cache_hit, cached_sandbox = domain_sandbox_cache.get(domain)
+    if cache_hit:
+        return cached_sandbox
+
+    sandbox = metadata_store.find_by_domain(domain)
+    if sandbox:
+        domain_sandbox_cache.set(domain, sandbox)
+        return sandbox
 
-    if response.get("Items"):
-        return response["Items"][0]["uuid"]["S"]
+    domain_sandbox_cache.set(domain, None, domain_cache_negative_ttl_seconds)
     return None
 
 
+def get_service_metadata(service_uuid):
+    return metadata_store.get(service_uuid, ["desired_tasks", "task_status", "wake_lease_until"])
+
+
+@metrics.instrument_handler
 def lambda_handler(event, context):
     try:
         host = event['requestContext']['domainName']
@@ -117,59 +657,379 @@ def lambda_handler(event, context):
             print(f"Domain mismatch: {full_domain} != {env_full_domain}")
             return {"statusCode": 404, "body": "Not Found"}
 
-        service_endpoint = fetch_service_instance(service_name, registry, full_domain, host)
+        ctx = RequestContext(host, service_name, registry, full_domain)
+        ctx.prefetch()
+
+        service_endpoint = fetch_service_instance(ctx)
+        if isinstance(service_endpoint, dict) and ctx.sandbox_asleep and wants_wake_wait(event):
+            service_endpoint = wait_for_service_instance(ctx, context)
         if isinstance(service_endpoint, dict):
             return service_endpoint
 
-        service_uuid = get_service_uuid_from_domain(host)
-        if service_uuid:
-            log_request_to_cloudwatch(service_uuid, host)
+        bookkeeping = [background_executor.submit(record_request_activity, ctx)]
 
-        return forward_request(event, service_endpoint)
+        try:
+            return forward_to_backend(event, ctx, service_endpoint)
+        finally:
+            wait_for_background(bookkeeping)
     except Exception as e:
         return {"statusCode": 500, "body": json.dumps({'error': str(e)})}
+    finally:
+        access_log_buffer.flush()
+
+
+def forward_to_backend(event, ctx, service_endpoint):
+    """Forward to the chosen instance, ejecting it on failure and failing over when the request was never sent."""
+    while True:
+        try:
+            return forward_request(event, service_endpoint, ctx)
+        except urllib3.exceptions.HTTPError as e:
+            backend_balancer.eject(service_endpoint)
+            upstream_pools.evict(service_endpoint)
+            if backend_balancer.all_ejected(ctx.backend_ips):
+                # every instance is out, make the next request rediscover them
+                backend_ip_cache.invalidate(ctx.full_service_name)
+                raise
+
+            if not isinstance(e, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError)):
+                raise
+
+            print(f"Backend {service_endpoint} refused the connection, failing over")
+            service_endpoint = backend_balancer.choose(ctx.full_service_name, ctx.backend_ips)
+
+
+def record_request_activity(ctx):
+    if ctx.service_uuid and not record_last_activity(ctx.service_uuid):
+        # the cached sandbox was deprovisioned and the PR provisioned again under the same CloudMap
+        # name, so discovery kept finding instances while activity went to the deleted row
+        print(f"Sandbox {ctx.service_uuid} of {ctx.host} no longer exists, looking the host up again")
+        ctx.refresh_sandbox()
+        if ctx.service_uuid:
+            record_last_activity(ctx.service_uuid)
+    if ctx.service_uuid:
+        log_request_to_cloudwatch(ctx.service_uuid, ctx.host)
+    access_log_buffer.flush()
+
+
+def record_last_activity(service_uuid):
+    """Move last_activity_at forward, at most once every activity_write_interval_seconds per sandbox.
+
+    The condition keeps the write throttled across all proxy containers, this one skips the call
+    entirely while its own last write is recent. Returns False when the sandbox's row no longer exists.
+    """
+    cache_hit, _ = activity_write_cache.get(service_uuid)
+    if cache_hit:
+        return True
+    activity_write_cache.set(service_uuid, True)
+
+    now = int(time.time())
+    try:
+        metadata_store.update(service_uuid).set(last_activity_at=now).commit(
+            condition=(
+                "attribute_exists(#uuid) AND "
+                "(attribute_not_exists(#last_activity_at) OR #last_activity_at < :write_before)"
+            ),
+            return_values_on_failure="ALL_OLD",
+            write_before=now - activity_write_interval_seconds
+        )
+    except metadata_store.client.exceptions.ConditionalCheckFailedException as e:
+        # the failed condition carries the row when another container recorded activity recently
+        return "Item" in e.response
+    except Exception:
+        activity_write_cache.invalidate(service_uuid)
+        raise
+    return True
+
+
+def wait_for_background(futures):
+    """Wait for bookkeeping tasks, reporting failures without failing the proxied request."""
+    deadline = time.monotonic() + background_wait_timeout_seconds
+    for future in futures:
+        try:
+            future.result(timeout=max(deadline - time.monotonic(), 0))
+        except Exception as e:
+            print(f"Background task failed: {e!r}")
 
 
 def log_request_to_cloudwatch(service_uuid, host):
     log_timestamp = int(time.time() * 1000)
-    log_event = {
-        "logEvents": [{
-            "timestamp": log_timestamp,
-            "message": f"Request at {log_timestamp} for {host}"
-        }],
-        "logGroupName": ecs_access_log_group_name,
-        "logStreamName": service_uuid
-    }
-
-    start_time = time.time()
-    cloudwatch_client.put_log_events(**log_event)
-    log_execution_time(start_time, "CloudWatch log entry")
+    access_log_buffer.record(service_uuid, f"Request at {log_timestamp} for {host}", log_timestamp)
 
 
-def forward_request(event, service_endpoint):
+def forward_request(event, service_endpoint, ctx=None):
     path = event.get('path', "")
-    url = f"http://{service_endpoint}{path}"  # TODO: Support HTTPS
+    method = event["httpMethod"]
+
+    if method not in SUPPORTED_HTTP_METHODS:
+        raise Exception(f"Unsupported HTTP method: {method}")
+
+    headers = event['headers'] or {}
+    cache_key = response_cache_key(event) if ctx is not None else None
+    cached = None
+    if cache_key is not None:
+        cached = response_cache.get(
+            ctx.full_service_name, ctx.backend_ips, cache_key, get_request_header(event, "Accept-Encoding")
+        )
+        request_directives = parse_cache_control([get_request_header(event, "Cache-Control") or ""])
+        if cached is not None and cached.is_fresh() and "no-cache" not in request_directives:
+            return build_cached_response(event, cached, "hit")
+
+        if cached is not None and cached.etag and not get_request_header(event, "If-None-Match"):
+            headers = {**headers, "If-None-Match": cached.etag}
+        else:
+            # only our own conditional requests can be answered from the cache
+            cached = None
 
+    url = f"http://{service_endpoint}{path}"  # TODO: Support HTTPS
     print(f"Forwarding request to {url}")
-    method = event["httpMethod"]
 
-    request_functions = {
-        "GET": requests.get,
-        "POST": requests.post,
-        "PUT": requests.put,
-        "DELETE": requests.delete,
-        "PATCH": requests.patch,
-    }
+    pool = upstream_pools.get(service_endpoint)
 
-    if method not in request_functions:
-        raise Exception(f"Unsupported HTTP method: {method}")
+    body = event.get('body')
+    if body is not None and event.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+
+    # redirects are returned to the client untouched, it is the one that should follow them
+    with metrics.timer("UpstreamRequest"):
+        response = pool.urlopen(
+            method,
+            path or "/",
+            body=body,
+            headers=headers,
+            redirect=False,
+            preload_content=False,
+            decode_content=False
+        )
+
+    upstream = read_upstream_response(event, response)
+    if isinstance(upstream, dict):
+        return upstream
+
+    if cached is not None and upstream.status == 304:
+        response_cache.refresh(cached, upstream.headers)
+        return build_cached_response(event, cached, "revalidated")
+
+    if cache_key is not None and prepare_cache_entry(event, upstream):
+        response_cache.store(ctx.full_service_name, ctx.backend_ips, cache_key, upstream)
+
+    return build_proxy_response(event, upstream)
+
+
+def read_upstream_response(event, response):
+    """Read a streamed upstream response into memory without decoding it to str."""
+    upstream_encoding = response.headers.get("Content-Encoding")
+
+    content_length = response.headers.get("Content-Length")
+    if (
+        event.get("httpMethod") != "HEAD"
+        and content_length and content_length.isdigit()
+        and int(content_length) > max_response_payload_bytes
+    ):
+        discard_response(response)
+        return payload_too_large_response(int(content_length))
+
+    # pass already-encoded bodies through untouched instead of decompressing and re-compressing them
+    body = response.read(max_response_payload_bytes + 1, decode_content=not upstream_encoding)
+    if len(body) > max_response_payload_bytes:
+        discard_response(response)
+        return payload_too_large_response(len(body))
+    response.release_conn()
+
+    headers = {}
+    for name in set(response.headers.keys()):
+        lowered = name.lower()
+        if lowered in HOP_BY_HOP_HEADERS or (lowered == "content-encoding" and not upstream_encoding):
+            continue
+        headers.setdefault(lowered, []).extend(response.headers.getlist(name))
 
-    start_time = time.time()
-    response = request_functions[method](url, headers=event['headers'], data=event['body'], timeout=10)
-    log_execution_time(start_time, "HTTP request forwarding")
+    content_type = response.headers.get("Content-Type", "application/json")
+    # a 304 or bodiless HEAD without a type leaves the client with the type of its cached representation
+    if response.status != 304 and (body or event.get("httpMethod") != "HEAD"):
+        headers.setdefault("content-type", [content_type])
+
+    return UpstreamResponse(response.status, headers, body, content_type, upstream_encoding)
+
+
+def build_proxy_response(event, upstream, headers=None):
+    """Convert an upstream response into an API Gateway proxy response, compressing text bodies."""
+    headers = {name: list(values) for name, values in (headers or upstream.headers).items()}
+    body = b"" if event.get("httpMethod") == "HEAD" else upstream.body
+    content_type = upstream.content_type
+
+    content_encoding = upstream.upstream_encoding
+    if not content_encoding and body and len(body) >= response_compression_min_bytes and is_text_content(content_type):
+        content_encoding = negotiate_content_encoding(get_request_header(event, "Accept-Encoding"))
+        if content_encoding:
+            body = compress_body(body, content_encoding)
+            headers["content-encoding"] = [content_encoding]
+            headers.setdefault("vary", []).append("Accept-Encoding")
+
+    is_base64_encoded = bool(content_encoding) or not is_text_content(content_type)
+    if not is_base64_encoded:
+        try:
+            encoded_body = body.decode(get_charset(content_type) or "utf-8")
+        except (UnicodeDecodeError, LookupError):
+            is_base64_encoded = True
+
+    if is_base64_encoded:
+        encoded_body = base64.b64encode(body).decode("ascii")
+
+    if len(encoded_body) > max_response_payload_bytes:
+        return payload_too_large_response(len(encoded_body))
 
     return {
-        'statusCode': response.status_code,
-        'body': response.text,
-        'headers': {'Content-Type': response.headers.get('Content-Type', 'application/json')},
-    }
\ No newline at end of file
+        'statusCode': upstream.status,
+        'body': encoded_body,
+        'multiValueHeaders': headers,
+        'isBase64Encoded': is_base64_encoded,
+    }
+
+
+def build_cached_response(event, entry, cache_status):
+    """Answer from the response cache, with a 304 when the client already holds the cached version."""
+    headers = dict(entry.headers)
+    headers["age"] = [str(int(time.monotonic() - entry.stored_at))]
+    headers["x-sandbox-cache"] = [cache_status]
+
+    if entry.etag and etag_matches(get_request_header(event, "If-None-Match"), entry.etag):
+        not_modified_headers = {
+            name: values for name, values in headers.items()
+            if name in ("etag", "cache-control", "expires", "vary", "age", "x-sandbox-cache")
+        }
+        return {"statusCode": 304, "body": "", "multiValueHeaders": not_modified_headers, "isBase64Encoded": False}
+
+    return build_proxy_response(event, entry, headers)
+
+
+def response_cache_key(event):
+    """Cache key of a request the response cache may answer, None when it always goes to the sandbox."""
+    if response_cache is None or event.get("httpMethod") not in ("GET", "HEAD"):
+        return None
+    if get_request_header(event, "Authorization"):
+        return None
+
+    query = event.get("multiValueQueryStringParameters") or {}
+    return event.get("path") or "/", tuple(sorted((name, tuple(values)) for name, values in query.items()))
+
+
+def prepare_cache_entry(event, upstream):
+    """Set the caching fields of a response, returns False when the sandbox did not allow it to be stored."""
+    if event.get("httpMethod") != "GET" or upstream.status != 200 or "set-cookie" in upstream.headers:
+        return False
+
+    directives = parse_cache_control(upstream.headers.get("cache-control", []))
+    if "no-store" in directives or "private" in directives:
+        return False
+
+    vary = {v.strip().lower() for value in upstream.headers.get("vary", []) for v in value.split(",")} - {""}
+    if vary - {"accept-encoding"}:
+        return False
+
+    lifetime = freshness_lifetime(upstream.headers)
+    etag = (upstream.headers.get("etag") or [None])[0]
+    if not lifetime and not etag:
+        return False
+
+    upstream.etag = etag
+    upstream.stored_at = time.monotonic()
+    upstream.fresh_until = upstream.stored_at + lifetime
+    if "accept-encoding" in vary and upstream.upstream_encoding:
+        # the sandbox compressed the body itself, only hand it to clients asking for the same encoding
+        upstream.accept_encoding = get_request_header(event, "Accept-Encoding") or ""
+    return True
+
+
+def parse_cache_control(values):
+    directives = {}
+    for value in values:
+        for directive in value.split(","):
+            name, _, argument = directive.strip().partition("=")
+            if name:
+                directives[name.lower()] = argument.strip('"')
+    return directives
+
+
+def freshness_lifetime(headers):
+    """Seconds a response may be served without revalidation, from s-maxage or max-age."""
+    directives = parse_cache_control(headers.get("cache-control", []))
+    if "no-cache" in directives:
+        return 0
+    for name in ("s-maxage", "max-age"):
+        if directives.get(name, "").isdigit():
+            return int(directives[name])
+    return 0
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison
+    weak = etag[2:] if etag.startswith("W/") else etag
+    return any((tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip()) == weak for tag in if_none_match.split(","))
+
+
+def discard_response(response):
+    # close rather than drain, the connection is dropped and the pool opens a fresh one next time
+    response.close()
+    response.release_conn()
+
+
+def get_charset(content_type):
+    for param in (content_type or "").split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "charset":
+            return value.strip('"') or None
+    return None
+
+
+def payload_too_large_response(size):
+    print(f"Upstream response of {size} bytes exceeds the {max_response_payload_bytes} byte payload limit")
+    return {"statusCode": 502, "body": json.dumps({'error': "Upstream response too large"})}
+
+
+def get_request_header(event, name):
+    lowered = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == lowered:
+            return value
+    return None
+
+
+def is_text_content(content_type):
+    media_type = (content_type or "").split(";", 1)[0].strip().lower()
+    return media_type.startswith("text/") or media_type in TEXT_CONTENT_TYPES or media_type.endswith(("+json", "+xml"))
+
+
+def negotiate_content_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
+
+    accepted, refused = set(), set()
+    for token in accept_encoding.split(","):
+        coding, _, params = token.strip().partition(";")
+        coding = coding.strip().lower()
+        quality = params.strip().lower()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    refused.add(coding)
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding)
+
+    if brotli is not None and "br" in accepted:
+        return "br"
+    # "*" stands for any coding not listed, never for one the client refused with q=0
+    if "gzip" in accepted or ("*" in accepted and "gzip" not in refused):
+        return "gzip"
+    return None
+
+
+def compress_body(body, content_encoding):
+    with metrics.timer(f"Compression.{content_encoding}"):
+        if content_encoding == "br":
+            return brotli.compress(body, quality=4)
+        return gzip.compress(body, compresslevel=5)
@@ -1,59 +1,29 @@
 import json
 import time
 
-import boto3
-from botocore.exceptions import ClientError
+from sandbox_shared.clients import lazy_client
+from sandbox_shared.metrics import metrics
+from sandbox_shared.schedules import SCHEDULE_TIME_FORMAT, arm_shutdown_schedule, needs_rearm
+from sandbox_shared.store import RUNNING, SandboxStore
 from os import environ
-from datetime import timedelta, datetime
+from datetime import datetime
 
 import logging
 
-ecs = boto3.client('ecs')
-ddb = boto3.client('dynamodb')
-scheduler = boto3.client('scheduler')
+ecs = lazy_client('ecs')
+ddb = lazy_client('dynamodb')
+scheduler = lazy_client('scheduler')
+store = SandboxStore(ddb, environ.get("metadata_ddb_table"))
 
 company_prefix = environ.get("company_prefix")
+idle_timeout_seconds = int(environ.get("idle_timeout_seconds", "600"))
+idle_reaper_enabled = environ.get("idle_reaper_enabled", "false").lower() == "true"
+schedule_rearm_hysteresis_seconds = int(environ.get("schedule_rearm_hysteresis_seconds", "300"))
 
 logger = logging.getLogger()
 
 
-def update_schedule(schedule_name: str, new_properties: dict):
-    existing_schedule = scheduler.get_schedule(
-        GroupName=environ.get("scheduler_group_name", ""),
-        Name=schedule_name
-    )
-
-    filtered_resp = {
-        k: v
-        for k, v in existing_schedule.items()
-        if k not in ["ResponseMetadata", "Arn", "CreationDate", "LastModificationDate"]
-
-    }
-
-    merged_response = filtered_resp | new_properties
-
-    scheduler_schedule = scheduler.update_schedule(**merged_response)
-
-    return scheduler_schedule
-
-def create_schedule(schedule_name: str, at, service_uuid):
-    return scheduler.create_schedule(
-        Name=schedule_name,
-        GroupName=environ.get("scheduler_group_name"),
-        ActionAfterCompletion="NONE",
-        FlexibleTimeWindow={
-            "Mode": "OFF"
-        },
-        ScheduleExpression=at,
-        Target={
-            "Arn": environ.get("shutdown_lambda_arn", ""),
-            "RoleArn": environ.get("scheduler_role_arn", ""),
-            "Input": json.dumps({
-                "service_uuid": service_uuid
-            })
-        }
-    )
-
+@metrics.instrument_handler
 def lambda_handler(event, context):
     service_uuid = event.get("service_uuid")
 
@@ -67,16 +37,11 @@ def lambda_handler(event, context):
 
     logger.debug(f"service_uuid: {service_uuid}")
 
-    dynamo_row = ddb.get_item(
-        TableName=environ.get("metadata_ddb_table"),
-        Key={
-            "uuid": {
-                "S": service_uuid
-            }
-        }
+    sandbox = store.get(
+        service_uuid, ["service_arn", "desired_tasks", "next_shutdown_at", "shutdown_schedule_arn"]
     )
 
-    if not dynamo_row.get("Item"):
+    if not sandbox:
         logger.debug(f"No metadata found for {service_uuid}")
         return {
             "statusCode": 404,
@@ -85,79 +50,59 @@ def lambda_handler(event, context):
             })
         }
 
-    service_arn = dynamo_row["Item"].get("service_arn", {}).get("S", None)
+    if event.get("prewarm") and sandbox.desired_tasks != 0:
+        logger.debug("Sandbox is already up, nothing to pre-warm")
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "message": "Service is already running"
+            })
+        }
 
-    if not service_arn:
+    if not sandbox.service_arn:
         ...  # todo: re-create ecs
         return
 
     ecs.update_service(
         cluster=environ.get("ecs_cluster_arn"),
-        service=service_arn,
+        service=sandbox.service_arn,
         desiredCount=1
     )
 
-    in_10_mins_datetime = datetime.now() + timedelta(minutes=10)
-    new_schedule = None
-
-    if dynamo_row["Item"].get("shutdown_schedule_arn"):
-        logger.debug("Existing schedule found, updating")
-        try:
-            existing_schedule = scheduler.get_schedule(
-                GroupName=environ.get("scheduler_group_name"),
-                Name=f"{company_prefix}-{service_uuid}"
-            )
-
-            filtered_resp = {
-                k: v
-                for k, v in existing_schedule.items()
-                if k not in ["ResponseMetadata", "Arn", "CreationDate", "LastModificationDate"]
-            }
-
-            merged_response = filtered_resp | {
-                "State": "ENABLED",
-                "ScheduleExpression": f"at({in_10_mins_datetime.strftime('%Y-%m-%dT%H:%M:%S')})"
-            }
-
-            scheduler.update_schedule(**merged_response)
-        except ClientError as err:
-            logger.debug(f"Error updating schedule: {err}")
-            if err.response['Error']['Code'] == 'ResourceNotFoundError':
-                logger.debug("Schedule not found, creating new one")
-                new_schedule = create_schedule(
-                    f"{company_prefix}-{service_uuid}",
-                    f"at({in_10_mins_datetime.strftime('%Y-%m-%dT%H:%M:%S')})",
-                    service_uuid
-                )
+    now = int(time.time())
+    # the earliest the sandbox can go idle, a still used one is kept up by shutdown-sandbox
+    deadline = datetime.fromtimestamp(now + idle_timeout_seconds)
+    # a stopped sandbox's schedule was disabled on shutdown, whatever next_shutdown_at still says
+    rearm = sandbox.desired_tasks == 0 or needs_rearm(
+        sandbox.next_shutdown_at, deadline, schedule_rearm_hysteresis_seconds
+    )
+
+    update = store.update(service_uuid).set(
+        desired_tasks=1,
+        updated_at=datetime.now().isoformat(),
+        task_status="STARTING",
+        # the request that woke the sandbox counts as activity, so the first idle check keeps it up
+        last_activity_at=now
+    )
+    if rearm:
+        update.set(next_shutdown_at=deadline.strftime(SCHEDULE_TIME_FORMAT))
+    if idle_reaper_enabled:
+        update.set(is_running=RUNNING)
+
+    if not rearm:
+        logger.debug("Shutdown is already far enough out, not re-arming")
+    elif idle_reaper_enabled:
+        logger.debug("Idle reaper enabled, not arming a schedule")
     else:
-        logger.debug("No existing schedule found, creating new one")
-        new_schedule = create_schedule(
-            f"{company_prefix}-{service_uuid}",
-            f"at({in_10_mins_datetime.strftime('%Y-%m-%dT%H:%M:%S')})",
-            service_uuid
+        new_schedule_arn = arm_shutdown_schedule(
+            scheduler, service_uuid, deadline, environ.get("shutdown_lambda_arn", ""),
+            exists=bool(sandbox.shutdown_schedule_arn)
         )
+        if new_schedule_arn:
+            logger.debug("Created a new shutdown schedule")
+            update.set(shutdown_schedule_arn=new_schedule_arn)
 
-    ddb.update_item(
-        TableName=environ.get("metadata_ddb_table"),
-        Key={
-            "uuid": {
-                "S": service_uuid
-            }
-        },
-        UpdateExpression=(
-            "SET desired_tasks = :desired_tasks, updated_at = :updated_at, task_status = :task_status"
-            + (", next_shutdown_at = :next_shutdown_at" if not new_schedule else "")
-        ),
-        ExpressionAttributeValues={
-            ":desired_tasks": {"N": "1"},
-            ":updated_at": {"S": datetime.now().isoformat()},
-            ":task_status": {"S": "STARTING"},
-            **(
-                {":next_shutdown_at": {"S": in_10_mins_datetime.strftime("%Y-%m-%dT%H:%M:%S")}}
-                if not new_schedule else {}
-            )
-        }
-    )
+    update.commit()
 
     return {
         "statusCode": 200,
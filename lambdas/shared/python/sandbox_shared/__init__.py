@@ -0,0 +1 @@
+"""Code shared by the sandbox Lambdas, shipped as the shared Lambda layer (mounted at /opt/python)."""
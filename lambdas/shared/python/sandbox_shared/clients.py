@@ -0,0 +1,45 @@
+from threading import Lock
+
+from sandbox_shared.metrics import metrics
+
+# boto3's default session is not thread safe, so clients are built one at a time
+_client_lock = Lock()
+
+
+class LazyClient:
+    """Stands in for a boto3 client and only builds it the first time an attribute is used.
+
+    Handlers keep module level names like ``ecs`` or ``ddb`` so warm invocations reuse the client, but a
+    cold start no longer pays for (or imports boto3 for) clients the invoked path never touches.
+    ``config`` may be a dict of ``botocore.config.Config`` arguments so botocore is not imported early.
+    """
+
+    def __init__(self, service_name, config=None):
+        self.service_name = service_name
+        self.config = config
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            with _client_lock:
+                if self._client is None:
+                    import boto3
+                    from botocore.config import Config
+
+                    config = Config(**self.config) if isinstance(self.config, dict) else self.config
+                    client = boto3.client(self.service_name, config=config)
+                    metrics.instrument_client(client)
+                    self._client = client
+        return self._client
+
+    @property
+    def is_initialised(self):
+        return self._client is not None
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def lazy_client(service_name, config=None):
+    return LazyClient(service_name, config=config)
@@ -0,0 +1,119 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+from os import environ
+from threading import Lock
+
+# CloudWatch accepts at most 100 values per metric in one EMF document
+MAX_VALUES_PER_METRIC = 100
+
+
+class Metrics:
+    """Collects latency timers during an invocation and writes them as CloudWatch Embedded Metric Format.
+
+    Every timer is keyed by operation and outcome and carries a Function dimension. EMF dimension values
+    are per document, so ``flush()`` writes one document per (operation, outcome) with all of its samples
+    batched into a value array, in a single stdout write at the end of the invocation. Nothing is sent
+    to CloudWatch directly, so it is testable offline by capturing stdout.
+    """
+
+    def __init__(self, namespace, function_name):
+        self.namespace = namespace
+        self.function_name = function_name
+        self._samples = {}
+        self._lock = Lock()
+
+    def record(self, operation, elapsed_ms, outcome="success"):
+        with self._lock:
+            self._samples.setdefault((operation, outcome), []).append(round(elapsed_ms, 3))
+
+    @contextmanager
+    def timer(self, operation):
+        start = time.perf_counter()
+        outcome = "success"
+        try:
+            yield
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            self.record(operation, (time.perf_counter() - start) * 1000, outcome)
+
+    def flush(self, stream=None):
+        with self._lock:
+            samples, self._samples = self._samples, {}
+        if not samples:
+            return
+
+        timestamp = int(time.time() * 1000)
+        documents = []
+        for (operation, outcome), values in sorted(samples.items()):
+            for i in range(0, len(values), MAX_VALUES_PER_METRIC):
+                documents.append(json.dumps({
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [{
+                            "Namespace": self.namespace,
+                            "Dimensions": [["Function", "Operation", "Outcome"], ["Function", "Operation"]],
+                            "Metrics": [{"Name": "Latency", "Unit": "Milliseconds"}],
+                        }],
+                    },
+                    "Function": self.function_name,
+                    "Operation": operation,
+                    "Outcome": outcome,
+                    "Latency": values[i:i + MAX_VALUES_PER_METRIC],
+                }, separators=(",", ":")))
+
+        stream = stream or sys.stdout
+        stream.write("\n".join(documents) + "\n")
+        stream.flush()
+
+    def instrument_handler(self, handler):
+        """Time the whole invocation and flush every metric recorded during it before returning."""
+
+        @wraps(handler)
+        def instrumented(event, context):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                response = handler(event, context)
+                status_code = response.get("statusCode", 200) if isinstance(response, dict) else 200
+                outcome = "error" if isinstance(status_code, int) and status_code >= 500 else "success"
+                return response
+            finally:
+                self.record("Invocation", (time.perf_counter() - start) * 1000, outcome)
+                self.flush()
+
+        return instrumented
+
+    def instrument_client(self, client):
+        """Register botocore hooks so every API call made with the client is timed as service.Operation."""
+        events = client.meta.events
+        service_id = client.meta.service_model.service_id.hyphenize()
+        events.register(f"before-call.{service_id}", self._before_aws_call)
+        events.register(f"after-call.{service_id}", self._after_aws_call)
+        events.register(f"after-call-error.{service_id}", self._after_aws_call_error)
+
+    def _before_aws_call(self, model, context, **kwargs):
+        context["metrics_call"] = (f"{model.service_model.service_name}.{model.name}", time.perf_counter())
+
+    def _after_aws_call(self, context, http_response=None, **kwargs):
+        outcome = "success" if http_response is None or http_response.status_code < 300 else "error"
+        self._record_aws_call(context, outcome)
+
+    def _after_aws_call_error(self, context, **kwargs):
+        # connection errors and timeouts, after-call is not emitted for these
+        self._record_aws_call(context, "error")
+
+    def _record_aws_call(self, context, outcome):
+        operation, start = context.pop("metrics_call", (None, None))
+        if operation is not None:
+            self.record(operation, (time.perf_counter() - start) * 1000, outcome)
+
+
+metrics = Metrics(
+    environ.get("metrics_namespace", "SandboxSystem"),
+    environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+)
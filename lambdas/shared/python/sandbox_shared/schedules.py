@@ -0,0 +1,67 @@
+import json
+from datetime import datetime, timedelta
+from os import environ
+
+# format of next_shutdown_at in the metadata table and of Scheduler at() expressions
+SCHEDULE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def schedule_name(service_uuid):
+    return f"{environ.get('company_prefix')}-{service_uuid}"
+
+
+def shutdown_schedule(service_uuid, at, shutdown_lambda_arn, enabled=True):
+    """Complete body of a sandbox's shutdown schedule, valid for both create_schedule and update_schedule.
+
+    update_schedule replaces every field of a schedule, so re-arming builds the body from config
+    here instead of reading the schedule back with get_schedule first.
+    """
+    return {
+        "Name": schedule_name(service_uuid),
+        "GroupName": environ.get("scheduler_group_name", ""),
+        "ActionAfterCompletion": "NONE",
+        "FlexibleTimeWindow": {
+            "Mode": "OFF"
+        },
+        "ScheduleExpression": f"at({at.strftime(SCHEDULE_TIME_FORMAT)})",
+        "State": "ENABLED" if enabled else "DISABLED",
+        "Target": {
+            "Arn": shutdown_lambda_arn,
+            "RoleArn": environ.get("scheduler_role_arn", ""),
+            "Input": json.dumps({
+                "service_uuid": service_uuid
+            })
+        }
+    }
+
+
+def arm_shutdown_schedule(scheduler, service_uuid, at, shutdown_lambda_arn, exists=True):
+    """Move the sandbox's shutdown schedule to ``at``, creating it when it does not exist.
+
+    Returns the ARN of a newly created schedule, None when an existing one was updated.
+    """
+    schedule = shutdown_schedule(service_uuid, at, shutdown_lambda_arn)
+    if exists:
+        try:
+            scheduler.update_schedule(**schedule)
+            return None
+        except scheduler.exceptions.ResourceNotFoundException:
+            print(f"Shutdown schedule of {service_uuid} not found, creating a new one")
+    return scheduler.create_schedule(**schedule)["ScheduleArn"]
+
+
+def needs_rearm(next_shutdown_at, deadline, hysteresis_seconds):
+    """False while the recorded next_shutdown_at is no more than ``hysteresis_seconds`` before ``deadline``.
+
+    A sandbox is only rescheduled once its new deadline has moved well past the recorded one, so a steadily
+    used sandbox is not rewritten on every check.
+    """
+    if not next_shutdown_at:
+        return True
+
+    try:
+        recorded = datetime.strptime(next_shutdown_at, SCHEDULE_TIME_FORMAT)
+    except ValueError:
+        return True
+
+    return deadline - recorded > timedelta(seconds=hysteresis_seconds)
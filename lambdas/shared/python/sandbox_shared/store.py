@@ -0,0 +1,343 @@
+import re
+import time
+
+# Attributes of a row in the sandbox metadata table and their python type, str is stored as S and int as N
+SANDBOX_FIELDS = {
+    "uuid": str,
+    "created_by_user_id": int,
+    "pr": int,
+    "repository": str,
+    "user": str,
+    "registry": str,
+    "domain": str,
+    "task_status": str,
+    "desired_tasks": int,
+    "running_tasks": int,
+    "created_at": str,
+    "updated_at": str,
+    "reconciled_at": str,
+    "task_definition_arn": str,
+    "cloudmap_service_arn": str,
+    "cloudmap_service_name": str,
+    "service_arn": str,
+    "shutdown_schedule_arn": str,
+    "next_shutdown_at": str,
+    "is_running": str,
+    "last_activity_at": int,
+    "wake_lease_until": int,
+    "pool_slot": str,
+    "deprovisioned_domain": str,
+}
+
+# value of is_running while a sandbox is up, the hash key of RunningIndex
+RUNNING = "1"
+
+# value of pool_slot on an unclaimed warm pool slot, the hash key of PoolIndex
+POOL_AVAILABLE = "available"
+
+# key prefixes of bookkeeping items that share the table with the sandboxes, sandbox uuids never contain "#"
+DOMAIN_CLAIM_PREFIX = "domain#"
+LEASE_PREFIX = "lease#"
+
+_PLACEHOLDER = re.compile(r"#(\w+)")
+
+
+def serialize(value):
+    if isinstance(value, bool):
+        return {"BOOL": value}
+    if isinstance(value, int):
+        return {"N": str(value)}
+    return {"S": str(value)}
+
+
+def deserialize(name, attribute):
+    if "N" in attribute:
+        return int(attribute["N"]) if SANDBOX_FIELDS.get(name, int) is int else attribute["N"]
+    if "S" in attribute:
+        return attribute["S"]
+    if "BOOL" in attribute:
+        return attribute["BOOL"]
+    return None
+
+
+def attribute_names(*expressions):
+    """ExpressionAttributeNames for every #name placeholder, each attribute is referenced by its own name."""
+    names = {}
+    for expression in expressions:
+        for name in _PLACEHOLDER.findall(expression or ""):
+            names[f"#{name}"] = name
+    return names
+
+
+class Sandbox:
+    """Compact typed view of a metadata row, attributes that were not read (or are not set) are None."""
+
+    __slots__ = tuple(SANDBOX_FIELDS)
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError(f"Unknown sandbox attributes: {', '.join(fields)}")
+
+    @classmethod
+    def from_item(cls, item):
+        return cls(**{name: deserialize(name, value) for name, value in item.items() if name in SANDBOX_FIELDS})
+
+    def to_item(self):
+        item = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                item[name] = serialize(SANDBOX_FIELDS[name](value))
+        return item
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__ if getattr(self, name) is not None)
+        return f"Sandbox({fields})"
+
+
+class SandboxUpdate:
+    """Collects the changes a handler makes to one sandbox and writes them with a single update_item.
+
+    Later ``set``/``remove`` calls for the same attribute win, so code paths can add to the update as
+    they go and ``commit()`` once at the end.
+    """
+
+    def __init__(self, store, service_uuid):
+        self.store = store
+        self.service_uuid = service_uuid
+        self._set = {}
+        self._remove = set()
+
+    def set(self, **fields):
+        for name, value in fields.items():
+            if name not in SANDBOX_FIELDS:
+                raise TypeError(f"Unknown sandbox attribute: {name}")
+            self._set[name] = SANDBOX_FIELDS[name](value)
+            self._remove.discard(name)
+        return self
+
+    def remove(self, *names):
+        for name in names:
+            if name not in SANDBOX_FIELDS:
+                raise TypeError(f"Unknown sandbox attribute: {name}")
+            self._remove.add(name)
+            self._set.pop(name, None)
+        return self
+
+    def __bool__(self):
+        return bool(self._set or self._remove)
+
+    def expression(self):
+        clauses = []
+        if self._set:
+            clauses.append("SET " + ", ".join(f"#{name} = :{name}" for name in self._set))
+        if self._remove:
+            clauses.append("REMOVE " + ", ".join(f"#{name}" for name in sorted(self._remove)))
+        return " ".join(clauses)
+
+    def commit(self, condition=None, return_values=None, return_values_on_failure=None, **condition_values):
+        """Write every collected change. ``condition`` may reference attributes as #name and values as :key.
+
+        With ``return_values_on_failure="ALL_OLD"`` a failed condition carries the current item, if there
+        is one, as ``Item`` in the ConditionalCheckFailedException response.
+        """
+        if not self:
+            return None
+
+        update_expression = self.expression()
+        values = {f":{name}": serialize(value) for name, value in self._set.items()}
+        values.update({f":{key}": serialize(value) for key, value in condition_values.items()})
+
+        request = {
+            "TableName": self.store.table_name,
+            "Key": {"uuid": {"S": self.service_uuid}},
+            "UpdateExpression": update_expression,
+            "ExpressionAttributeNames": attribute_names(update_expression, condition),
+        }
+        if condition:
+            request["ConditionExpression"] = condition
+        if values:
+            request["ExpressionAttributeValues"] = values
+        if return_values:
+            request["ReturnValues"] = return_values
+        if return_values_on_failure:
+            request["ReturnValuesOnConditionCheckFailure"] = return_values_on_failure
+
+        response = self.store.client.update_item(**request)
+        self._set, self._remove = {}, set()
+        return response
+
+
+class SandboxStore:
+    """Data access for the sandbox metadata table, shared by every sandbox Lambda.
+
+    Reads take the attributes the caller needs so only those are returned (and paid for), and rows come
+    back as ``Sandbox`` records instead of raw DynamoDB attribute dicts.
+    """
+
+    def __init__(self, client, table_name):
+        self.client = client
+        self.table_name = table_name
+
+    def _projection(self, attributes):
+        if not attributes:
+            return {}
+        expression = ", ".join(f"#{name}" for name in attributes)
+        return {"ProjectionExpression": expression, "ExpressionAttributeNames": attribute_names(expression)}
+
+    def get(self, service_uuid, attributes=None, consistent=False):
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={"uuid": {"S": service_uuid}},
+            ConsistentRead=consistent,
+            **self._projection(attributes)
+        ).get("Item")
+        return Sandbox.from_item(item) if item else None
+
+    def put(self, sandbox, condition=None):
+        request = {"TableName": self.table_name, "Item": sandbox.to_item()}
+        if condition:
+            request["ConditionExpression"] = condition
+            request["ExpressionAttributeNames"] = attribute_names(condition)
+        return self.client.put_item(**request)
+
+    def delete(self, service_uuid, condition=None):
+        request = {"TableName": self.table_name, "Key": {"uuid": {"S": service_uuid}}}
+        if condition:
+            request["ConditionExpression"] = condition
+            request["ExpressionAttributeNames"] = attribute_names(condition)
+        return self.client.delete_item(**request)
+
+    def update(self, service_uuid):
+        return SandboxUpdate(self, service_uuid)
+
+    def find_by_domain(self, domain):
+        """The sandbox serving a domain from DomainIndex, only uuid, domain and cloudmap_service_name are set."""
+        response = self.client.query(
+            TableName=self.table_name,
+            IndexName="DomainIndex",
+            KeyConditionExpression="#domain = :domain",
+            ExpressionAttributeNames={"#domain": "domain"},
+            ExpressionAttributeValues={":domain": {"S": domain}}
+        )
+        items = response.get("Items")
+        return Sandbox.from_item(items[0]) if items else None
+
+    def find_uuid_by_domain(self, domain):
+        sandbox = self.find_by_domain(domain)
+        return sandbox.uuid if sandbox else None
+
+    def scan(self, attributes=None):
+        paginator = self.client.get_paginator("scan")
+        for page in paginator.paginate(TableName=self.table_name, **self._projection(attributes)):
+            for item in page.get("Items", []):
+                if "#" in item.get("uuid", {}).get("S", ""):
+                    continue  # a domain claim or lease, not a sandbox
+                yield Sandbox.from_item(item)
+
+    def domain_claim(self, domain):
+        """(owner uuid, claim_expires_at) of the domain's claim, read consistently, None when it is unclaimed."""
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={"uuid": {"S": DOMAIN_CLAIM_PREFIX + domain}},
+            ConsistentRead=True
+        ).get("Item")
+        if not item:
+            return None
+        expires_at = item.get("claim_expires_at")
+        return item["owner_uuid"]["S"], int(expires_at["N"]) if expires_at else None
+
+    def claim_domain(self, domain, owner_uuid, expires_at=None, previous_owner=None):
+        """Make owner_uuid the owner of the domain.
+
+        Only succeeds while the domain is unclaimed, or still owned by ``previous_owner`` when given, and
+        raises ConditionalCheckFailedException otherwise. ``expires_at`` (epoch seconds) lets a later
+        provision take over a claim whose owner never got a metadata row.
+        """
+        item = {"uuid": {"S": DOMAIN_CLAIM_PREFIX + domain}, "owner_uuid": {"S": owner_uuid}}
+        if expires_at is not None:
+            item["claim_expires_at"] = serialize(int(expires_at))
+
+        request = {"TableName": self.table_name, "Item": item}
+        if previous_owner:
+            request["ConditionExpression"] = "#owner_uuid = :previous_owner"
+            request["ExpressionAttributeNames"] = {"#owner_uuid": "owner_uuid"}
+            request["ExpressionAttributeValues"] = {":previous_owner": {"S": previous_owner}}
+        else:
+            request["ConditionExpression"] = "attribute_not_exists(#uuid)"
+            request["ExpressionAttributeNames"] = {"#uuid": "uuid"}
+        return self.client.put_item(**request)
+
+    def release_domain(self, domain, owner_uuid):
+        """Drop the domain's claim if owner_uuid still holds it, returns whether it did."""
+        try:
+            self.client.delete_item(
+                TableName=self.table_name,
+                Key={"uuid": {"S": DOMAIN_CLAIM_PREFIX + domain}},
+                ConditionExpression="#owner_uuid = :owner",
+                ExpressionAttributeNames={"#owner_uuid": "owner_uuid"},
+                ExpressionAttributeValues={":owner": {"S": owner_uuid}}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def running_until(self, before):
+        """uuids of running sandboxes whose next_shutdown_at is at or before ``before``, from RunningIndex."""
+        paginator = self.client.get_paginator("query")
+        for page in paginator.paginate(
+            TableName=self.table_name,
+            IndexName="RunningIndex",
+            KeyConditionExpression="#is_running = :running AND #next_shutdown_at <= :before",
+            ExpressionAttributeNames={"#is_running": "is_running", "#next_shutdown_at": "next_shutdown_at"},
+            ExpressionAttributeValues={":running": {"S": RUNNING}, ":before": {"S": before}}
+        ):
+            for item in page.get("Items", []):
+                yield item["uuid"]["S"]
+
+    def pool_slots(self, limit=None):
+        """uuids of unclaimed warm pool slots, from PoolIndex."""
+        paginator = self.client.get_paginator("query")
+        for page in paginator.paginate(
+            TableName=self.table_name,
+            IndexName="PoolIndex",
+            KeyConditionExpression="#pool_slot = :available",
+            ExpressionAttributeNames={"#pool_slot": "pool_slot"},
+            ExpressionAttributeValues={":available": {"S": POOL_AVAILABLE}},
+            PaginationConfig={"MaxItems": limit} if limit else {}
+        ):
+            for item in page.get("Items", []):
+                yield item["uuid"]["S"]
+
+    def acquire_lease(self, name, owner, seconds):
+        """Hold the named lease for ``seconds`` unless another owner holds an unexpired one, returns whether it did."""
+        now = int(time.time())
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    "uuid": {"S": LEASE_PREFIX + name},
+                    "owner_uuid": {"S": owner},
+                    "lease_until": serialize(now + int(seconds))
+                },
+                ConditionExpression="attribute_not_exists(#uuid) OR #lease_until < :now",
+                ExpressionAttributeNames={"#uuid": "uuid", "#lease_until": "lease_until"},
+                ExpressionAttributeValues={":now": serialize(now)}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def release_lease(self, name, owner):
+        try:
+            self.client.delete_item(
+                TableName=self.table_name,
+                Key={"uuid": {"S": LEASE_PREFIX + name}},
+                ConditionExpression="#owner_uuid = :owner",
+                ExpressionAttributeNames={"#owner_uuid": "owner_uuid"},
+                ExpressionAttributeValues={":owner": {"S": owner}}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass  # expired and taken over by another owner
@@ -1,51 +1,93 @@
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
+from sandbox_shared.clients import lazy_client
+from sandbox_shared.metrics import metrics
+from sandbox_shared.schedules import SCHEDULE_TIME_FORMAT, needs_rearm, shutdown_schedule
+from sandbox_shared.store import RUNNING, SandboxStore
 from os import environ
 from datetime import timedelta, datetime
 
-ecs = boto3.client('ecs')
-ddb = boto3.client('dynamodb')
-cloudmap = boto3.client('servicediscovery')
-scheduler = boto3.client('scheduler')
-cloudwatch_logs = boto3.client('logs')
+ecs = lazy_client('ecs')
+ddb = lazy_client('dynamodb')
+cloudmap = lazy_client('servicediscovery')
+scheduler = lazy_client('scheduler')
+store = SandboxStore(ddb, environ.get("metadata_ddb_table"))
 
 company_prefix = environ.get("company_prefix")
+idle_timeout_seconds = int(environ.get("idle_timeout_seconds", "600"))
+idle_reaper_enabled = environ.get("idle_reaper_enabled", "false").lower() == "true"
+reaper_max_workers = int(environ.get("reaper_max_workers", "10"))
+reaper_time_margin_ms = int(environ.get("reaper_time_margin_ms", "5000"))
+schedule_rearm_hysteresis_seconds = int(environ.get("schedule_rearm_hysteresis_seconds", "300"))
 
 
-def update_schedule(schedule_name: str, new_properties: dict):
-    existing_schedule = scheduler.get_schedule(
-        GroupName=environ.get("scheduler_group_name"),
-        Name=schedule_name
-    )
+@metrics.instrument_handler
+def lambda_handler(event, context):
+    if event.get("reap"):
+        return reap_idle_sandboxes(context)
 
-    filtered_resp = {
-        k: v
-        for k, v in existing_schedule.items()
-        if k not in ["ResponseMetadata", "Arn", "CreationDate", "LastModificationDate"]
+    return shutdown_sandbox(event["service_uuid"], event.get("force_shutdown"), shutdown_lambda_arn(context))
 
-    }
 
-    merged_response = filtered_resp | new_properties
+def shutdown_lambda_arn(context):
+    # schedules target this function, so its own ARN is known without a (cyclic) Terraform variable
+    return getattr(context, "invoked_function_arn", None) or environ.get("shutdown_lambda_arn", "")
 
-    scheduler_schedule = scheduler.update_schedule(**merged_response)
 
-    return scheduler_schedule
+def reap_idle_sandboxes(context):
+    """Shut down every running sandbox whose next_shutdown_at has passed, replacing per-sandbox schedules.
 
-def lambda_handler(event, context):
-    service_uuid = event["service_uuid"]
-
-    dynamo_row = ddb.get_item(
-        TableName=environ.get("metadata_ddb_table"),
-        Key={
-            "uuid": {
-                "S": service_uuid
-            }
-        }
+    Invoked periodically with {"reap": true}. Running sandboxes carry ``is_running`` so only they appear in the
+    sparse RunningIndex, sorted by next_shutdown_at. Sandboxes left over when the invocation runs low on
+    time are picked up by the next sweep.
+    """
+    expired = list(store.running_until(datetime.now().strftime(SCHEDULE_TIME_FORMAT)))
+
+    print(f"{len(expired)} sandboxes past their shutdown time")
+
+    lambda_arn = shutdown_lambda_arn(context)
+
+    def reap(service_uuid):
+        # checked when a worker picks the sandbox up, everything is submitted at once and waited on below
+        if context is not None and context.get_remaining_time_in_millis() < reaper_time_margin_ms:
+            return None
+        return shutdown_sandbox(service_uuid, False, lambda_arn)["statusCode"]
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=reaper_max_workers) as executor:
+        futures = {executor.submit(reap, service_uuid): service_uuid for service_uuid in expired}
+
+        for future, service_uuid in futures.items():
+            try:
+                results[service_uuid] = future.result()
+            except Exception as e:
+                print(f"Error shutting down {service_uuid}: {e!r}")
+                results[service_uuid] = 500
+
+    deferred = sum(1 for status in results.values() if status is None)
+    if deferred:
+        print(f"Running low on time, leaving {deferred} sandboxes for the next sweep")
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "expired": len(expired),
+            "shutdown": sum(1 for status in results.values() if status == 200),
+            "still_used": sum(1 for status in results.values() if status == 400),
+            "failed": sum(1 for status in results.values() if status is not None and status >= 500),
+            "deferred": deferred
+        })
+    }
+
+
+def shutdown_sandbox(service_uuid, force_shutdown=False, lambda_arn=""):
+    sandbox = store.get(
+        service_uuid, ["service_arn", "last_activity_at", "next_shutdown_at", "shutdown_schedule_arn", "is_running"]
     )
 
-    if not dynamo_row.get("Item"):
+    if not sandbox:
         print("No metadata found for service_uuid")
         return {
             "statusCode": 404,
@@ -54,30 +96,33 @@ def lambda_handler(event, context):
             })
         }
 
-    now = int(time.time() * 1000)  # Current time in milliseconds
-    ten_minutes_ago = now - 600000  # 10 minutes in milliseconds
-
-    # Query CloudWatch logs
-    response = cloudwatch_logs.filter_log_events(
-        logGroupName=environ.get("ecs_access_log_group_name"),
-        logStreamNames=[service_uuid],
-        startTime=ten_minutes_ago,
-        endTime=now,
-        limit=1
-    )
-
-    print(response)
+    # proxy-request keeps last_activity_at (epoch seconds) current while the sandbox is receiving requests
+    last_activity_at = sandbox.last_activity_at or 0
+    print(f"Last activity at {last_activity_at}")
 
-    # Check if there are events
-    if response.get("events") and not event.get("force_shutdown"):
+    if last_activity_at >= time.time() - idle_timeout_seconds and not force_shutdown:
         print("Service is still being used")
 
-        update_schedule(f"{company_prefix}-{service_uuid}", {
-            "ScheduleExpression": f"at({(datetime.now() + timedelta(minutes=10)).strftime('%Y-%m-%dT%H:%M:%S')})",
-            "FlexibleTimeWindow": {
-                "Mode": "OFF"
-            }
-        })
+        # the sandbox can go idle idle_timeout_seconds after its last request, not before
+        deadline = datetime.fromtimestamp(last_activity_at + idle_timeout_seconds)
+        update = store.update(service_uuid)
+        if idle_reaper_enabled:
+            if needs_rearm(sandbox.next_shutdown_at, deadline, schedule_rearm_hysteresis_seconds):
+                update.set(next_shutdown_at=deadline.strftime(SCHEDULE_TIME_FORMAT))
+            else:
+                # still due, the next sweep looks at it again without a write in between
+                print(f"Idle deadline {deadline} is close to {sandbox.next_shutdown_at}, not re-arming")
+        else:
+            # the one-shot schedule has fired, it always has to be moved, but never closer than the hysteresis
+            shutdown_at = max(deadline, datetime.now() + timedelta(seconds=schedule_rearm_hysteresis_seconds))
+            scheduler.update_schedule(**shutdown_schedule(service_uuid, shutdown_at, lambda_arn))
+            update.set(next_shutdown_at=shutdown_at.strftime(SCHEDULE_TIME_FORMAT))
+
+        # sandboxes from before the reaper, or provisioned by the Step Functions flow, are not in RunningIndex
+        # yet and their one-shot schedule has just fired, the reaper has to take over their shutdown
+        if idle_reaper_enabled and sandbox.is_running != RUNNING:
+            update.set(is_running=RUNNING)
+        update.commit()
 
         return {
             "statusCode": 400,
@@ -86,56 +131,23 @@ def lambda_handler(event, context):
             })
         }
 
-    service_arn = dynamo_row["Item"]["service_arn"]["S"]
-
     ecs.update_service(
         cluster=environ.get("ecs_cluster_arn"),
-        service=service_arn,
+        service=sandbox.service_arn,
         desiredCount=0
     )
 
-    ddb.update_item(
-        TableName=environ.get("metadata_ddb_table"),
-        Key={
-            "uuid": {
-                "S": service_uuid
-            }
-        },
-        UpdateExpression="SET desired_tasks = :desired_tasks, task_status = :task_status, next_shutdown = :next_shutdown",
-        ExpressionAttributeValues={
-            ":desired_tasks": {
-                "N": "0"
-            },
-            ":task_status": {
-                "S": "STOPPED"
-            },
-            ":next_shutdown": {
-                "S": ""
-            }
-        }
-    )
-
-
-    if dynamo_row["Item"].get("shutdown_schedule_arn"):
-        existing_schedule = scheduler.get_schedule(
-            GroupName=environ.get("scheduler_group_name"),
-            Name=f"{company_prefix}-{service_uuid}"
-        )
-
-        filtered_resp = {
-            k: v
-            for k, v in existing_schedule.items()
-            if k not in ["ResponseMetadata", "Arn", "CreationDate", "LastModificationDate"]
+    # dropping is_running takes the sandbox out of the reaper's RunningIndex
+    store.update(service_uuid).set(desired_tasks=0, task_status="STOPPED").remove(
+        "next_shutdown_at", "is_running"
+    ).commit()
 
-        }
-
-        merged_response = filtered_resp | {"State": "DISABLED"}
-
-        scheduler.update_schedule(**merged_response)
+    if sandbox.shutdown_schedule_arn:
+        scheduler.update_schedule(**shutdown_schedule(service_uuid, datetime.now(), lambda_arn, enabled=False))
 
     return {
         "statusCode": 200,
         "body": json.dumps({
             "message": "Service shutdown successfully"
         })
-    }
\ No newline at end of file
+    }
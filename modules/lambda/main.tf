@@ -87,9 +87,10 @@ resource "aws_lambda_function" "lambda" {
     mode = "Active"  # X-Ray
   }
 
-  layers = [
-    aws_lambda_layer_version.dependencies.arn
-  ]
+  layers = concat(
+    [aws_lambda_layer_version.dependencies.arn],
+    var.lambda_layer_arns
+  )
 }
 
 resource "aws_lambda_permission" "apigw_perm" {
@@ -157,4 +157,10 @@ variable "lambda_dependencies_zip_path" {
   description = "The path to the lambda dependencies ZIP file"
   type        = string
   default     = ""
-}
\ No newline at end of file
+}
+
+variable "lambda_layer_arns" {
+  description = "Additional layer ARNs attached after the dependencies layer, e.g. the shared sandbox code layer"
+  type        = list(string)
+  default     = []
+}
@@ -1,3 +1,41 @@
+locals {
+  sandbox_container_definitions = [
+    {
+      "Name" : "sandbox",
+      "Image" : "nginxdemos/hello",
+      "Cpu" : 256,
+      "Memory" : 512,
+      "Essential" : true,
+      "PortMappings" : [
+        {
+          "Name" : "port80",
+          "ContainerPort" : 80,
+          "HostPort" : 80,
+          "Protocol" : "tcp",
+          "AppProtocol" : "http"
+        }
+      ],
+      "LogConfiguration" : {
+        "LogDriver" : "awslogs",
+        "Options" : {
+          "awslogs-group" : aws_cloudwatch_log_group.ecs.name,
+          "awslogs-region" : var.region,
+          "awslogs-stream-prefix" : "ecs"
+        }
+      }
+    }
+  ]
+
+  # sandboxes with the same container spec share one task definition family, named after the spec
+  sandbox_task_family = "${var.company_prefix}-td-${substr(sha256(jsonencode({
+    "ContainerDefinitions" : local.sandbox_container_definitions,
+    "TaskRoleArn" : aws_iam_role.ecs_task_role.arn,
+    "ExecutionRoleArn" : aws_iam_role.ecs_execution_role.arn,
+    "Cpu" : "256",
+    "Memory" : "512"
+  })), 0, 16)}"
+}
+
 resource "aws_sfn_state_machine" "provision_sandbox" {
   name     = "${var.company_prefix}-provision-sandbox"
   role_arn = module.provision_sandbox_lambda.execution_role_arn
@@ -83,6 +121,10 @@ resource "aws_sfn_state_machine" "provision_sandbox" {
             },
             "updated_at" : {
               "S.$" : "$$.State.EnteredTime"
+            },
+            # joins RunningIndex once shutdown-sandbox records next_shutdown_at, so the idle reaper can take over
+            "is_running" : {
+              "S" : "1"
             }
           }
         },
@@ -127,43 +169,34 @@ resource "aws_sfn_state_machine" "provision_sandbox" {
             }
           },
           {
-            "StartAt" : "CreateEcsTaskDefinition",
+            "StartAt" : "DescribeEcsTaskDefinition",
             "States" : {
+              "DescribeEcsTaskDefinition" : {
+                "Type" : "Task",
+                "Resource" : "arn:aws:states:::aws-sdk:ecs:describeTaskDefinition",
+                "ResultPath" : "$.task_definition",
+                "Parameters" : {
+                  "TaskDefinition" : local.sandbox_task_family
+                },
+                "Catch" : [
+                  {
+                    "ErrorEquals" : ["Ecs.ClientException"],
+                    "ResultPath" : null,
+                    "Next" : "CreateEcsTaskDefinition"
+                  }
+                ],
+                "Next" : "SaveEcsTaskDefinition"
+              },
               "CreateEcsTaskDefinition" : {
                 "Type" : "Task",
                 "Resource" : "arn:aws:states:::aws-sdk:ecs:registerTaskDefinition",
                 "ResultPath" : "$.task_definition"
                 "Parameters" : {
-                  "Family.$" : "States.Format('{}-{}', '${var.company_prefix}', $.service_uuid.service_uuid)"
+                  "Family" : local.sandbox_task_family
                   "TaskRoleArn" : aws_iam_role.ecs_task_role.arn,
                   "ExecutionRoleArn" : aws_iam_role.ecs_execution_role.arn,
                   "NetworkMode" : "awsvpc",
-                  "ContainerDefinitions" : [
-                    {
-                      "Name" : "sandbox",
-                      "Image" : "nginxdemos/hello",
-                      "Cpu" : 256,
-                      "Memory" : 512,
-                      "Essential" : true,
-                      "PortMappings" : [
-                        {
-                          "Name" : "port80",
-                          "ContainerPort" : 80,
-                          "HostPort" : 80,
-                          "Protocol" : "tcp",
-                          "AppProtocol" : "http"
-                        }
-                      ],
-                      "LogConfiguration" : {
-                        "LogDriver" : "awslogs",
-                        "Options" : {
-                          "awslogs-group" : aws_cloudwatch_log_group.ecs.name,
-                          "awslogs-region" : var.region,
-                          "awslogs-stream-prefix" : "ecs"
-                        }
-                      }
-                    }
-                  ],
+                  "ContainerDefinitions" : local.sandbox_container_definitions,
                   "RuntimePlatform" : {
                     "CpuArchitecture" : "X86_64",
                     "OperatingSystemFamily" : "LINUX"
@@ -12,6 +12,54 @@ variable "domain" {
   default     = "example.com"
 }
 
+variable "idle_reaper_enabled" {
+  type        = bool
+  description = "Shut idle sandboxes down from one periodic reaper sweep instead of a Scheduler schedule per sandbox"
+  default     = true
+}
+
+variable "prewarm_enabled" {
+  type        = bool
+  description = "Start stopped sandboxes shortly before the hours they are usually used in"
+  default     = true
+}
+
+variable "prewarm_max_concurrent" {
+  type        = number
+  description = "Most sandboxes the pre-warm planner starts for one hour"
+  default     = 10
+}
+
+variable "warm_pool_size" {
+  type        = number
+  description = "Unclaimed sandbox slots kept pre-created so provisioning only has to scale one up, 0 disables the pool"
+  default     = 5
+}
+
+variable "response_cache_enabled" {
+  type        = bool
+  description = "Cache cacheable sandbox responses in the proxy Lambda's memory"
+  default     = false
+}
+
+variable "gc_enabled" {
+  type        = bool
+  description = "Delete sandboxes that have been idle for longer than gc_retention_days once a day"
+  default     = true
+}
+
+variable "gc_retention_days" {
+  type        = number
+  description = "Days a stopped sandbox is kept without activity before the garbage collection sweep deletes it"
+  default     = 14
+}
+
+variable "provision_batch_concurrency" {
+  type        = number
+  description = "Most sandboxes a batch provision creates at once, keeps bursts under the ECS and CloudMap rate limits"
+  default     = 4
+}
+
 ### ---- VPC ----
 
 variable "vpc_cidr" {